@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Load test for the API. Starts a throwaway Postgres cluster and an API
+process pointed at it, seeds the database, then drives a mixed workload
+at a fixed concurrency and reports latency percentiles and throughput
+for each endpoint.
+
+Requires the Postgres server binaries (initdb, pg_ctl, pg_basebackup) on
+the PATH, or in the directory given with --pg-bin. With --replicas, that
+many streaming replicas of the cluster are started too and the API sends
+reads to them. Run from the repository root.
+"""
+
+import json
+import os
+import psycopg2
+import psycopg2.extras
+import random
+import requests
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from pathlib import Path
+
+API_PATH = Path("src/python/api.py")
+SEED_DATA_PATH = Path("data/seed_data.json")
+SNAPSHOTS_PATH = Path("data/snapshots.json")
+DB_NAME = "isometric_bench"
+PASSWORD = "password"
+# Components the workload needs, which the API initializes in the
+# background after it starts listening
+READY_COMPONENTS = ("schema", "snapshots", "model")
+
+DEFAULT_MIX = {
+    "login": 1,
+    "budget_list": 20,
+    "expense_list": 40,
+    "expense_create": 10,
+    "model_predict": 5,
+}
+
+
+class Postgres:
+    """
+    A Postgres cluster in a temporary directory, listening only on a unix
+    socket in that directory. Given a primary, it is started as a
+    streaming replica of that cluster instead.
+    """
+    def __init__(self, pg_bin=None, port=55432, primary=None):
+        self.pg_bin = pg_bin
+        self.port = port
+        self.primary = primary
+        self.directory = Path(tempfile.mkdtemp(prefix="isometric-bench-"))
+        self.data = self.directory / "data"
+
+    def bin(self, name):
+        return str(Path(self.pg_bin) / name) if self.pg_bin else name
+
+    @property
+    def env(self):
+        return {"PGHOST": str(self.directory), "PGPORT": str(self.port)}
+
+    @property
+    def dsn(self):
+        return f"dbname={DB_NAME} host={self.directory} port={self.port}"
+
+    def start(self):
+        if self.primary is None:
+            subprocess.run([self.bin("initdb"), "-D", str(self.data), "-A", "trust", "-E", "UTF8"],
+                    check=True, stdout=subprocess.DEVNULL)
+        else:
+            # Copy the primary, set up to follow it once started
+            subprocess.run([
+                self.bin("pg_basebackup"), "-h", str(self.primary.directory), "-p", str(self.primary.port),
+                "-D", str(self.data), "-R", "-X", "stream", "-c", "fast"
+            ], check=True)
+        subprocess.run([
+            self.bin("pg_ctl"), "-D", str(self.data), "-l", str(self.directory / "postgres.log"),
+            "-o", f"-k {self.directory} -p {self.port} -c listen_addresses=''",
+            "-w", "start"
+        ], check=True, stdout=subprocess.DEVNULL)
+        if self.primary is None:
+            subprocess.run([self.bin("createdb"), "-h", str(self.directory), "-p", str(self.port), DB_NAME],
+                    check=True)
+
+    def connect(self):
+        return psycopg2.connect(dbname=DB_NAME, host=str(self.directory), port=self.port)
+
+    def stop(self):
+        subprocess.run([self.bin("pg_ctl"), "-D", str(self.data), "-m", "fast", "-w", "stop"],
+                stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ApiProcess:
+    def __init__(self, postgres, port, model_dir, snapshots, threads, replicas=(), sticky_seconds=0):
+        self.url = f"http://127.0.0.1:{port}"
+        self.env = dict(os.environ)
+        self.env.update(postgres.env)
+        self.env.update({
+            "ISOMETRIC_DB": DB_NAME,
+            "ISOMETRIC_PORT": str(port),
+            "ISOMETRIC_MODEL_DIR": str(Path(model_dir).resolve()),
+            "ISOMETRIC_SNAPSHOTS": str(Path(snapshots).resolve()),
+            "ISOMETRIC_THREADS": str(threads),
+            "ISOMETRIC_DB_REPLICAS": ",".join(replica.dsn for replica in replicas),
+            "ISOMETRIC_DB_STICKY_SECONDS": str(sticky_seconds),
+        })
+        self.process = None
+
+    def start(self, timeout=300):
+        self.process = subprocess.Popen(
+            [sys.executable, "-u", API_PATH.name], cwd=API_PATH.parent, env=self.env
+        )
+        # Wait for the port to accept requests and the components the
+        # workload uses to finish initializing, every route returns 503
+        # until then
+        deadline = time.monotonic() + timeout
+        components = {}
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("API process exited during startup")
+            try:
+                components = requests.get(self.url + "/ready", timeout=1).json()["components"]
+            except requests.ConnectionError:
+                pass
+            else:
+                if all(components.get(name, {}).get("ready") for name in READY_COMPONENTS):
+                    return
+            time.sleep(0.5)
+        raise TimeoutError(f"API was not ready in time: {components}")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def seed(api, postgres, users, expenses_per_category):
+    """
+    Register users through the API, then bulk insert a chain of four
+    budgets per user, with categories and expenses from the seed data.
+    Returns a list of per-user fixtures for the workload to use.
+    """
+    with open(SEED_DATA_PATH) as f:
+        seed_data = json.load(f)
+
+    fixtures = []
+    session = requests.Session()
+    for i in range(users):
+        username = f"bench_user_{i}"
+        reply = session.post(api.url + "/register", json={"username": username, "password": PASSWORD}).json()
+        fixtures.append({"username": username, "user_id": reply["id"], "categories": []})
+
+    today = date.today()
+    now = datetime.now()
+    connection = postgres.connect()
+    with connection, connection.cursor() as cursor:
+        for fixture in fixtures:
+            previous_budget_id = None
+            for quarter in range(1, 5):
+                cursor.execute(
+                    "INSERT INTO budgets (budget_name, previous_budget_id) VALUES (%s, %s) RETURNING budget_id;",
+                    (f"{fixture['username']} Q{quarter}", previous_budget_id)
+                )
+                budget_id = cursor.fetchone()[0]
+                if previous_budget_id is not None:
+                    cursor.execute("UPDATE budgets SET next_budget_id=%s WHERE budget_id=%s;",
+                            (budget_id, previous_budget_id))
+                cursor.execute(
+                    "INSERT INTO budget_permissions (budget_id, user_id, permissions) VALUES (%s, %s, 8);",
+                    (budget_id, fixture["user_id"])
+                )
+                for category in seed_data["percentages"]:
+                    cursor.execute(
+                        "INSERT INTO categories (budget_id, category_name) VALUES (%s, %s) RETURNING category_id;",
+                        (budget_id, category)
+                    )
+                    category_id = cursor.fetchone()[0]
+                    fixture["categories"].append((budget_id, category_id))
+                    items = seed_data["items"][category]
+                    psycopg2.extras.execute_values(cursor, """
+                        INSERT INTO expenses (category_id, expense_description, expense_amount,
+                                              expense_date, entry_time)
+                        VALUES %s;
+                    """, [
+                        (
+                            category_id, random.choice(items),
+                            Decimal(random.randrange(100, 100000)) / 100,
+                            today - timedelta(days=random.randrange(365)), now
+                        ) for _ in range(expenses_per_category)
+                    ])
+                previous_budget_id = budget_id
+    connection.close()
+    return fixtures
+
+
+class Worker(threading.Thread):
+    def __init__(self, api, fixture, mix, series, deadline, results):
+        super().__init__(daemon=True)
+        self.api = api
+        self.fixture = fixture
+        self.operations = list(mix.keys())
+        self.weights = list(mix.values())
+        self.series = series
+        self.deadline = deadline
+        self.results = results
+        self.session = requests.Session()
+        self.authtoken = None
+
+    def call(self, endpoint, data):
+        if self.authtoken is not None:
+            data["authtoken"] = self.authtoken
+        start = time.perf_counter()
+        response = self.session.post(self.api.url + endpoint, json=data)
+        latency = time.perf_counter() - start
+        return response, latency
+
+    def login(self):
+        response, latency = self.call("/login", {"username": self.fixture["username"], "password": PASSWORD})
+        if response.ok:
+            self.authtoken = response.json()["authtoken"]
+        return response, latency
+
+    def budget_list(self):
+        return self.call("/budget/list", {})
+
+    def expense_list(self):
+        budget_id, category_id = random.choice(self.fixture["categories"])
+        return self.call("/expense/list", {"budget_id": budget_id, "category_id": category_id})
+
+    def expense_create(self):
+        budget_id, category_id = random.choice(self.fixture["categories"])
+        return self.call("/expense/create", {
+            "budget_id": budget_id, "category_id": category_id,
+            "description": "Benchmark expense", "expense_amount": "$12.34",
+            "expense_date": date.today().isoformat()
+        })
+
+    def model_predict(self):
+        return self.call("/model/predict", {"values": random.choice(self.series)})
+
+    def run(self):
+        self.login()
+        while time.monotonic() < self.deadline:
+            operation = random.choices(self.operations, self.weights)[0]
+            try:
+                response, latency = getattr(self, operation)()
+                self.results.append((operation, latency, response.status_code < 400))
+            except requests.RequestException:
+                self.results.append((operation, None, False))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def summarize(results, duration):
+    summary = {}
+    for operation in sorted({op for op, latency, _ in results if latency is not None}):
+        latencies = sorted(latency for op, latency, ok in results if op == operation and latency is not None)
+        errors = sum(1 for op, _, ok in results if op == operation and not ok)
+        summary[operation] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput": len(latencies) / duration,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+        }
+    return summary
+
+
+def print_summary(summary, baseline=None):
+    print(f"{'endpoint':<16}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for operation, stats in summary.items():
+        print(f"{operation:<16}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput']:>10.1f}"
+            f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+        if baseline is not None and operation in baseline:
+            old = baseline[operation]
+            changes = "".join(
+                f"{change(old[key], stats[key]):>10}"
+                for key in ("throughput", "p50_ms", "p95_ms", "p99_ms")
+            )
+            print(f"{'  vs baseline':<34}{changes}")
+
+
+def change(old, new):
+    if not old:
+        return "-"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-u", "--users", type=int, default=10, help="Users to seed, each with four budgets.")
+    parser.add_argument("-e", "--expenses-per-category", type=int, default=50)
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Simultaneous clients.")
+    parser.add_argument("-d", "--duration", type=float, default=30, help="Seconds to run the workload for.")
+    parser.add_argument("-m", "--mix", type=str, default=None,
+            help="Workload weights as JSON, e.g. '{\"budget_list\": 1, \"expense_list\": 3}'.")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="API server threads.")
+    parser.add_argument("--port", type=int, default=8090, help="Port for the API under test.")
+    parser.add_argument("--pg-port", type=int, default=55432)
+    parser.add_argument("--pg-bin", type=str, default=None, help="Directory with initdb and pg_ctl.")
+    parser.add_argument("-r", "--replicas", type=int, default=0,
+            help="Streaming replicas to start and route reads to.")
+    parser.add_argument("--sticky-seconds", type=float, default=1,
+            help="How long a user's reads stay on the primary after they write.")
+    parser.add_argument("--model-dir", type=str, default="appdata/model")
+    parser.add_argument("--snapshots", type=str, default=SNAPSHOTS_PATH)
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, for repeatable runs.")
+    parser.add_argument("-s", "--save-baseline", type=str, default=None, help="Write results to this JSON file.")
+    parser.add_argument("-b", "--baseline", type=str, default=None, help="Compare against this JSON file.")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    mix = json.loads(args.mix) if args.mix else DEFAULT_MIX
+    with open(args.snapshots) as f:
+        series = list(json.load(f).values())
+
+    postgres = Postgres(args.pg_bin, args.pg_port)
+    replicas = [Postgres(args.pg_bin, args.pg_port + 1 + i, primary=postgres) for i in range(args.replicas)]
+    api = ApiProcess(postgres, args.port, args.model_dir, args.snapshots, args.threads,
+            replicas, args.sticky_seconds)
+    try:
+        print("=== Starting Postgres ===")
+        postgres.start()
+        for replica in replicas:
+            replica.start()
+        print("=== Starting API ===")
+        api.start()
+        print("=== Seeding ===")
+        fixtures = seed(api, postgres, args.users, args.expenses_per_category)
+
+        print(f"=== Running {args.concurrency} clients for {args.duration}s ===")
+        results = []
+        deadline = time.monotonic() + args.duration
+        workers = [
+            Worker(api, fixtures[i % len(fixtures)], mix, series, deadline, results)
+            for i in range(args.concurrency)
+        ]
+        start = time.monotonic()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        duration = time.monotonic() - start
+    finally:
+        api.stop()
+        for replica in replicas:
+            replica.stop()
+        postgres.stop()
+
+    summary = summarize(results, duration)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["summary"]
+    print_summary(summary, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({
+                "args": {key: str(value) for key, value in vars(args).items()},
+                "summary": summary,
+            }, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
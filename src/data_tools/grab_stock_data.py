@@ -4,23 +4,232 @@
 # Ticker Values: https://polygon.io
 
 import json
+import os
 import random
+import tempfile
 import requests
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
 from pathlib import Path
 
 API_KEY_PATH=Path("~/.stocks-api-key").expanduser()
-API_BASE_URL="https://api.polygon.io/v1/open-close/{}/{}?apiKey={}"
-API_KEY = API_KEY_PATH.read_text().strip()
+API_BASE_URL="https://api.polygon.io"
+API_PATH="/v1/open-close/{}/{}?apiKey={}"
 
 INPUT_PATH = Path("data/S&P500.json")
 OUTPUT_PATH = Path("data/snapshots.json")
+CHECKPOINT_PATH = Path("data/snapshots.checkpoint")
 
+# Days between consecutive snapshots of a symbol
+SNAPSHOT_INTERVAL = timedelta(days=30)
+# Snapshots are due every SNAPSHOT_INTERVAL counted from this day, so
+# runs started on different days ask for the same dates
+SNAPSHOT_EPOCH = date(2000, 1, 3)
 
-def get_stock_data(symbol: str, day: date):
-    url = API_BASE_URL.format(symbol, day.isoformat(), API_KEY)
-    return requests.get(url).json()
+# HTTP statuses that are worth retrying after a pause
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Response statuses that will not change if the request is repeated
+FINAL_STATUSES = {'OK', 'NOT_FOUND'}
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket. Holds up to `capacity` tokens and refills
+    at `rate` tokens per second. acquire() blocks until a token is free.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Drain the bucket so every worker backs off, not just the one
+        # that was told to slow down.
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class Checkpoint:
+    """
+    Append-only record of every (symbol, date) response that has been
+    fetched, so an interrupted run can resume without refetching.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.responses = {}
+        self.lock = threading.Lock()
+        if self.path.exists():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn final line from an interrupted write
+                        continue
+                    self.responses[(record['symbol'], record['date'])] = record['response']
+        self.file = open(self.path, "a")
+
+    def get(self, symbol: str, day: date):
+        return self.responses.get((symbol, day.isoformat()), None)
+
+    def record(self, symbol: str, day: date, response):
+        with self.lock:
+            self.responses[(symbol, day.isoformat())] = response
+            self.file.write(json.dumps({
+                "symbol": symbol,
+                "date": day.isoformat(),
+                "response": response
+            }) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def snapshot_date(day: date):
+    """
+    The first day a snapshot is due on or after day.
+    """
+    offset = (day - SNAPSHOT_EPOCH) % SNAPSHOT_INTERVAL
+    return day if not offset else day + SNAPSHOT_INTERVAL - offset
+
+
+class StockDataFetcher:
+    def __init__(self, api_key, base_url=API_BASE_URL, rate=5/60, burst=1, retries=5,
+            backoff=1, checkpoint=None):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        # Seconds to wait before the first retry, doubling on each one
+        self.backoff = backoff
+        self.checkpoint = checkpoint
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        # requests.Session is not thread safe, so each worker keeps its own
+        # keep-alive session for the life of the pool.
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def get_stock_data(self, symbol: str, day: date):
+        # Use the checkpointed response if this pair was already fetched
+        if self.checkpoint is not None:
+            stock_data = self.checkpoint.get(symbol, day)
+            if stock_data is not None:
+                return stock_data
+        # Otherwise fetch it, then record it for next time
+        stock_data = self.request(self.base_url + API_PATH.format(symbol, day.isoformat(), self.api_key))
+        if self.checkpoint is not None and stock_data.get('status') in FINAL_STATUSES:
+            self.checkpoint.record(symbol, day, stock_data)
+        return stock_data
+
+    def request(self, url):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                response = self.session.get(url, timeout=30)
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    raise
+                print(f"request failed ({e}), retrying in {delay}s")
+                # Only this worker's request failed, so only it waits
+                time.sleep(delay + random.uniform(0, delay / 2))
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response.json()
+                if attempt == self.retries:
+                    response.raise_for_status()
+                # Honor the server's requested pause if it gave one
+                retry_after = response.headers.get('Retry-After')
+                if retry_after is not None and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                print(f"HTTP {response.status_code}, retrying in {delay}s")
+                # The next acquire() waits out the pause, in every worker
+                self.bucket.pause(delay + random.uniform(0, delay / 2))
+            delay = min(delay * 2, 60)
+
+    def get_symbol_snapshots(self, symbol: str, start: date, end: date):
+        """
+        Returns the snapshots due between start and end, along with the
+        date of the last snapshot taken (or None if there were none). Each
+        snapshot is taken on the first trading day from the day it is due.
+        """
+        symbol_snapshots = []
+        last_day = None
+        due = snapshot_date(start)
+        # Run until the end date
+        while due < end:
+            day = due
+            while day < end and day < due + SNAPSHOT_INTERVAL:
+                # Skip weekends
+                while day.isoweekday() > 5:
+                    day += timedelta(days=1)
+                # Get stock data for the day
+                stock_data = self.get_stock_data(symbol, day)
+                print(symbol, day, stock_data)
+                # If the day has no data, skip it
+                if stock_data['status'] != 'OK':
+                    day += timedelta(days=3)
+                    continue
+                # Append the stock data to the list
+                symbol_snapshots.append(stock_data['open'])
+                last_day = day
+                break
+            # Advance to the next snapshot
+            due += SNAPSHOT_INTERVAL
+        return symbol_snapshots, last_day
+
+
+def index_path(output_path):
+    output_path = Path(output_path)
+    return output_path.with_name(output_path.stem + ".index.json")
+
+
+def load_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def write_json_atomic(path, data):
+    """
+    Write JSON to a temporary file next to path, then rename it over path
+    so readers only ever see the old or the new file, never a partial one.
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
 
 
 def main():
@@ -29,12 +238,38 @@ def main():
     parser.add_argument("-d", "--days", type=int, default=1825, help="Days back to start querying.")
     parser.add_argument("-s", "--symbol", type=str, default=None, help="Specific symbol to query.")
     parser.add_argument("-o", "--output", type=str, default=OUTPUT_PATH, help="JSON output path.")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Number of symbols to fetch concurrently.")
+    parser.add_argument("-r", "--rate", type=float, default=5, help="Requests allowed per minute.")
+    parser.add_argument("-b", "--burst", type=int, default=1, help="Requests allowed in a single burst.")
+    parser.add_argument("--retries", type=int, default=5, help="Retries per request before giving up.")
+    parser.add_argument("--checkpoint", type=str, default=CHECKPOINT_PATH, help="Checkpoint file path.")
+    parser.add_argument("--base-url", type=str, default=API_BASE_URL, help="API base URL.")
+    parser.add_argument("-a", "--append", action="store_true", help="Only fetch snapshots newer than those already stored.")
     args = parser.parse_args()
 
     if args.symbol is not None and args.count is not None:
         parser.error("--count and --symbol are mutually exclusive")
 
-    if args.symbol is None:
+    checkpoint = Checkpoint(args.checkpoint)
+    fetcher = StockDataFetcher(
+        API_KEY_PATH.read_text().strip(), args.base_url, rate=args.rate/60,
+        burst=args.burst, retries=args.retries, checkpoint=checkpoint
+    )
+
+    # The index records, per symbol, the date of the last stored snapshot
+    # and how many snapshots were stored at that point.
+    if args.append:
+        data = load_json(args.output, {})
+        index = load_json(index_path(args.output), {})
+    else:
+        data = {}
+        index = {}
+
+    if args.symbol is not None:
+        symbols = {args.symbol}
+    elif args.append and args.count is None:
+        symbols = set(data.keys())
+    else:
         if args.count is None:
             args.count = 5
 
@@ -45,40 +280,44 @@ def main():
         while len(symbols) < args.count:
             added_symbols = random.sample(all_symbols, args.count - len(symbols))
             for symbol in added_symbols:
-                stock_data = get_stock_data(symbol, date(2015, 6, 1))
+                stock_data = fetcher.get_stock_data(symbol, date(2015, 6, 1))
                 print(stock_data)
                 if stock_data['status'] == 'OK':
                     symbols.add(symbol)
-    else:
-        symbols = {args.symbol}
 
     today = date.today()
-    data = {}
+    # Work out where each symbol should resume from
+    starts = {}
     for symbol in symbols:
-        symbol_snapshots = []
-        # Start 5 years ago
-        day = today - timedelta(days=args.days)
-        # Run until today
-        while day < today:
-            # Skip weekends
-            while day.isoweekday() > 5:
-                day += timedelta(days=1)
-            # Get stock data for the day
-            stock_data = get_stock_data(symbol, day)
-            print(symbol, day, stock_data)
-            # If the day has no data, skip it
-            if stock_data['status'] != 'OK':
-                day += timedelta(days=3)
-                continue
-            # Append the stock data to the list
-            symbol_snapshots.append(stock_data['open'])
-            # Advance 30 days
-            day += timedelta(days=30)
-        data[symbol] = symbol_snapshots
-
-    with open(args.output, "w") as f:
-        json.dump(data, f)
+        entry = index.get(symbol, None)
+        if entry is None:
+            # Unindexed symbols get their full history refetched
+            data[symbol] = []
+            starts[symbol] = today - timedelta(days=args.days)
+        else:
+            # Drop any snapshots written after the index was last updated,
+            # they are refetched below (cheaply, through the checkpoint).
+            data[symbol] = data.get(symbol, [])[:entry['count']]
+            starts[symbol] = date.fromisoformat(entry['last_date']) + timedelta(days=1)
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            futures = {
+                symbol: pool.submit(fetcher.get_symbol_snapshots, symbol, start, today)
+                for symbol, start in starts.items()
+            }
+            for symbol, future in futures.items():
+                symbol_snapshots, last_day = future.result()
+                data[symbol].extend(symbol_snapshots)
+                if last_day is not None:
+                    index[symbol] = {"last_date": last_day.isoformat(), "count": len(data[symbol])}
+    finally:
+        checkpoint.close()
 
+    # Snapshots go first so a crash in between leaves the index behind
+    # the data, which the next --append run detects and repairs.
+    write_json_atomic(args.output, data)
+    write_json_atomic(index_path(args.output), index)
 
 if __name__ == '__main__':
     main()
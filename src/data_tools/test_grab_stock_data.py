@@ -0,0 +1,167 @@
+import json
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+import requests
+
+import grab_stock_data
+from grab_stock_data import Checkpoint, StockDataFetcher, snapshot_date
+
+
+class StubApi:
+    """
+    Serves the open-close endpoint on localhost. Queued (status, headers)
+    replies are sent first, after that every weekday has a price except
+    the days in missing.
+    """
+    def __init__(self):
+        self.requests = []
+        self.queued = []
+        self.missing = set()
+        self.lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path, _, query = self.path.partition("?")
+                _, _, _, symbol, day = path.split("/")
+                with api.lock:
+                    api.requests.append((symbol, date.fromisoformat(day), query))
+                    reply = api.queued.pop(0) if api.queued else None
+                if reply is not None:
+                    status, headers = reply
+                    body = {"status": "ERROR"}
+                elif date.fromisoformat(day) in api.missing:
+                    status, headers = 200, {}
+                    body = {"status": "NOT_FOUND"}
+                else:
+                    status, headers = 200, {}
+                    body = {"status": "OK", "open": date.fromisoformat(day).toordinal() % 1000}
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def requested_days(self):
+        with self.lock:
+            return [day for _, day, _ in self.requests]
+
+
+class StockDataFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.api = StubApi()
+        self.addCleanup(self.api.close)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def fetcher(self, **kwargs):
+        kwargs.setdefault("rate", 1000)
+        kwargs.setdefault("backoff", 0.01)
+        return StockDataFetcher("key", self.api.url, **kwargs)
+
+    def test_retries_server_errors(self):
+        self.api.queued = [(503, {}), (500, {})]
+        stock_data = self.fetcher(retries=2).get_stock_data("AAA", date(2020, 1, 6))
+        self.assertEqual(stock_data["status"], "OK")
+        self.assertEqual(len(self.api.requests), 3)
+
+    def test_gives_up_after_retries(self):
+        self.api.queued = [(503, {})] * 3
+        with self.assertRaises(requests.HTTPError):
+            self.fetcher(retries=2).get_stock_data("AAA", date(2020, 1, 6))
+        self.assertEqual(len(self.api.requests), 3)
+
+    def test_backoff_waits_once(self):
+        self.api.queued = [(503, {})]
+        started = time.monotonic()
+        self.fetcher(retries=1, backoff=0.5).get_stock_data("AAA", date(2020, 1, 6))
+        elapsed = time.monotonic() - started
+        # One delay plus at most half of it again as jitter
+        self.assertGreaterEqual(elapsed, 0.5)
+        self.assertLess(elapsed, 1.0)
+
+    def test_honors_retry_after(self):
+        self.api.queued = [(429, {"Retry-After": "1"})]
+        started = time.monotonic()
+        stock_data = self.fetcher(retries=1).get_stock_data("AAA", date(2020, 1, 6))
+        self.assertGreaterEqual(time.monotonic() - started, 1)
+        self.assertEqual(stock_data["status"], "OK")
+
+    def test_checkpoint_resumes_on_a_later_day(self):
+        path = Path(self.directory.name, "checkpoint")
+        first_end = date(2021, 3, 10)
+        self.api.missing = {snapshot_date(date(2020, 6, 1))}
+        checkpoint = Checkpoint(path)
+        first, _ = self.fetcher(checkpoint=checkpoint).get_symbol_snapshots(
+            "AAA", first_end - timedelta(days=365), first_end)
+        checkpoint.close()
+        first_days = set(self.api.requested_days())
+
+        # Resume weeks later with the same number of days of history
+        self.api.requests.clear()
+        second_end = first_end + timedelta(days=45)
+        checkpoint = Checkpoint(path)
+        second, last_day = self.fetcher(checkpoint=checkpoint).get_symbol_snapshots(
+            "AAA", second_end - timedelta(days=365), second_end)
+        checkpoint.close()
+        second_days = set(self.api.requested_days())
+
+        self.assertTrue(second_days)
+        self.assertFalse(first_days & second_days)
+        self.assertTrue(all(day >= first_end - timedelta(days=3) for day in second_days))
+        # Snapshots that were due in both runs come from the checkpoint
+        resumed = len(second) - len(second_days)
+        self.assertEqual(second[:resumed], first[len(first) - resumed:])
+        self.assertLess(last_day, second_end)
+
+    def test_main_appends_through_base_url(self):
+        directory = Path(self.directory.name)
+        key_path = directory / "key"
+        key_path.write_text("secret\n")
+        output = directory / "snapshots.json"
+        arguments = ["grab_stock_data.py", "--symbol", "AAA", "--days", "120",
+            "--rate", "60000", "--base-url", self.api.url,
+            "--checkpoint", str(directory / "checkpoint"), "--output", str(output)]
+        with mock.patch.object(grab_stock_data, "API_KEY_PATH", key_path):
+            with mock.patch.object(sys, "argv", arguments):
+                grab_stock_data.main()
+            self.assertTrue(self.api.requests)
+            self.assertTrue(all(query == "apiKey=secret" for _, _, query in self.api.requests))
+            snapshots = json.loads(output.read_text())
+            self.assertEqual(len(snapshots["AAA"]), len(self.api.requests))
+            index = json.loads(grab_stock_data.index_path(output).read_text())
+            self.assertEqual(index["AAA"]["count"], len(snapshots["AAA"]))
+
+            # Nothing new is due, so appending fetches nothing
+            self.api.requests.clear()
+            with mock.patch.object(sys, "argv", arguments + ["--append"]):
+                grab_stock_data.main()
+            self.assertFalse(self.api.requests)
+            self.assertEqual(json.loads(output.read_text()), snapshots)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,21 +4,30 @@ import functools
 import hashlib
 import json
 import os
+import queue
 import secrets
 import signal
 import sys
+import time
 from datetime import datetime, date
 from enum import IntFlag
 from hmac import compare_digest
 from typing import Optional, Union
 
 # Pip dependency imports
-from flask import session, request, abort
+from flask import Response, session, request, abort
 
 # Project imports
-from sql_interface import DB, PrimaryKey, ForeignKey, Money
-from json_flask import JsonFlask, UserId, DateStr
-from model import StockModel
+from sql_interface import DB, PrimaryKey, ForeignKey, Money, OptionalMoney, Unique, Triggers, Initialize, Indexes
+from sql_interface import PartitionBy, RangePartitions
+from json_flask import JsonFlask, UserId, DateStr, OptionalDateStr, current_user_id
+from model_registry import ModelRegistry
+from batching import MicroBatcher
+from snapshots import SnapshotStore
+from cache import Cache
+from response_cache import AllScopes
+from notifications import BudgetNotifier, ALL_BUDGETS
+from tokens import TokenSigner, TokenDenylist, parse_keys
 
 
 # Set up SIGTERM handler
@@ -35,14 +44,40 @@ class Permissions(IntFlag):
     ADMIN = 4
     OWNER = 8
 
+# Deployment configuration
+DB_NAME = os.environ.get("ISOMETRIC_DB", "isometric")
+# Comma separated replica DSNs to send reads to, and how long a user's
+# reads stay on the primary after they write
+DB_REPLICAS = [dsn for dsn in os.environ.get("ISOMETRIC_DB_REPLICAS", "").split(",") if dsn.strip()]
+DB_STICKY_SECONDS = float(os.environ.get("ISOMETRIC_DB_STICKY_SECONDS", "0"))
+MODEL_DIR = os.environ.get("ISOMETRIC_MODEL_DIR", "/model")
+SNAPSHOTS_PATH = os.environ.get("ISOMETRIC_SNAPSHOTS", "/data/snapshots.json")
+PORT = int(os.environ.get("ISOMETRIC_PORT", "80"))
+THREADS = int(os.environ.get("ISOMETRIC_THREADS", "4"))
+# Each open event stream holds one of the server's threads, so only this
+# many are allowed at once, and each is closed after a while for the
+# client to reconnect
+EVENT_STREAMS = int(os.environ.get("ISOMETRIC_EVENT_STREAMS", str(THREADS // 2)))
+EVENT_STREAM_SECONDS = float(os.environ.get("ISOMETRIC_EVENT_STREAM_SECONDS", "300"))
+# Comma separated key_id:base64_secret keys to sign auth tokens with,
+# newest first. Without them tokens only work in the process that issued
+# them.
+TOKEN_KEYS = os.environ.get("ISOMETRIC_TOKEN_KEYS", "")
+TOKEN_HOURS = float(os.environ.get("ISOMETRIC_TOKEN_HOURS", "8"))
+
 # Globals
-db = DB("isometric", schema={
+db = DB(DB_NAME, schema={
     "users": {
         "user_id": PrimaryKey,
         "user_name": str,
         "user_pw_hash": bytes,
         "user_pw_salt": bytes,
     },
+    "revoked_tokens": {
+        "token_id": str,
+        "expires_at": datetime,
+        Unique: [("token_id",)],
+    },
     "budgets": {
         "budget_id": PrimaryKey,
         "ticker_symbol": str,
@@ -60,6 +95,22 @@ db = DB("isometric", schema={
         "category_id": PrimaryKey,
         "budget_id": ForeignKey("budgets", "budget_id"),
         "category_name": str,
+        Triggers: {
+            # By the time a category's expenses are deleted along with it
+            # their budget can no longer be looked up, so take the whole
+            # category out of its budget's totals first
+            "categories_summarize": ("BEFORE DELETE", """
+                BEGIN
+                    UPDATE budget_totals
+                    SET expense_total=budget_totals.expense_total-category_totals.expense_total,
+                        expense_count=budget_totals.expense_count-category_totals.expense_count
+                    FROM category_totals
+                    WHERE budget_totals.budget_id=OLD.budget_id
+                    AND category_totals.category_id=OLD.category_id;
+                    RETURN OLD;
+                END;
+            """),
+        },
     },
     "expenses": {
         "expense_id": PrimaryKey,
@@ -67,10 +118,114 @@ db = DB("isometric", schema={
         "expense_description": str,
         "expense_amount": Money,
         "expense_date": date,
-        "entry_time": datetime
+        "entry_time": datetime,
+        # A partition per year, so old years can be archived and queries
+        # for a date range only touch the years in it
+        PartitionBy: RangePartitions("expense_date", "year", ahead=1),
+        # For /expense/search. The full text one only matches queries using
+        # this exact expression, the trigram one speeds up ILIKE '%...%'.
+        Indexes: {
+            "expenses_description_text": "USING gin (to_tsvector('english', expense_description))",
+            "expenses_description_trigram": "USING gin (expense_description gin_trgm_ops)",
+        },
+        Triggers: {
+            "expenses_summarize": ("AFTER INSERT OR UPDATE OR DELETE", """
+                BEGIN
+                    -- Only ever update on the way out, so rows removed by a
+                    -- cascading delete are not recreated
+                    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                        UPDATE category_monthly_totals
+                        SET expense_total=expense_total-OLD.expense_amount,
+                            expense_count=expense_count-1
+                        WHERE category_id=OLD.category_id
+                        AND month=date_trunc('month', OLD.expense_date)::date;
+                        UPDATE category_totals
+                        SET expense_total=expense_total-OLD.expense_amount,
+                            expense_count=expense_count-1
+                        WHERE category_id=OLD.category_id;
+                        -- Finds nothing if the category is being deleted,
+                        -- which categories_summarize has accounted for
+                        UPDATE budget_totals
+                        SET expense_total=expense_total-OLD.expense_amount,
+                            expense_count=expense_count-1
+                        WHERE budget_id=(
+                            SELECT budget_id FROM categories
+                            WHERE category_id=OLD.category_id
+                        );
+                    END IF;
+                    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                        INSERT INTO category_monthly_totals
+                        (category_id, month, expense_total, expense_count)
+                        VALUES (NEW.category_id, date_trunc('month', NEW.expense_date)::date,
+                            NEW.expense_amount, 1)
+                        ON CONFLICT (category_id, month) DO UPDATE
+                        SET expense_total=category_monthly_totals.expense_total+EXCLUDED.expense_total,
+                            expense_count=category_monthly_totals.expense_count+1;
+                        INSERT INTO category_totals
+                        (category_id, expense_total, expense_count)
+                        VALUES (NEW.category_id, NEW.expense_amount, 1)
+                        ON CONFLICT (category_id) DO UPDATE
+                        SET expense_total=category_totals.expense_total+EXCLUDED.expense_total,
+                            expense_count=category_totals.expense_count+1;
+                        INSERT INTO budget_totals
+                        (budget_id, expense_total, expense_count)
+                        SELECT budget_id, NEW.expense_amount, 1
+                        FROM categories WHERE category_id=NEW.category_id
+                        ON CONFLICT (budget_id) DO UPDATE
+                        SET expense_total=budget_totals.expense_total+EXCLUDED.expense_total,
+                            expense_count=budget_totals.expense_count+1;
+                    END IF;
+                    RETURN NULL;
+                END;
+            """),
+        },
+    },
+    # Expense totals per category, and per budget, kept up to date by the
+    # expenses_summarize and categories_summarize triggers
+    "category_totals": {
+        "category_id": ForeignKey("categories", "category_id"),
+        "expense_total": Money,
+        "expense_count": int,
+        Unique: [("category_id",)],
+        Initialize: """
+            INSERT INTO category_totals
+            (category_id, expense_total, expense_count)
+            SELECT category_id, SUM(expense_amount), COUNT(*)
+            FROM expenses GROUP BY category_id;
+        """,
+    },
+    "budget_totals": {
+        "budget_id": ForeignKey("budgets", "budget_id"),
+        "expense_total": Money,
+        "expense_count": int,
+        Unique: [("budget_id",)],
+        Initialize: """
+            INSERT INTO budget_totals
+            (budget_id, expense_total, expense_count)
+            SELECT categories.budget_id, SUM(expense_amount), COUNT(*)
+            FROM expenses JOIN categories
+            ON categories.category_id=expenses.category_id
+            GROUP BY categories.budget_id;
+        """,
     },
-})
-db.validate_schema()
+    # Expense totals per category and month, kept up to date by the
+    # expenses_summarize trigger
+    "category_monthly_totals": {
+        "category_id": ForeignKey("categories", "category_id"),
+        "month": date,
+        "expense_total": Money,
+        "expense_count": int,
+        Unique: [("category_id", "month")],
+        Initialize: """
+            INSERT INTO category_monthly_totals
+            (category_id, month, expense_total, expense_count)
+            SELECT category_id, date_trunc('month', expense_date)::date,
+                SUM(expense_amount), COUNT(*)
+            FROM expenses GROUP BY 1, 2;
+        """,
+    },
+}, replicas=DB_REPLICAS, sticky_key=current_user_id, sticky_seconds=DB_STICKY_SECONDS,
+    extensions=["pg_trgm"])
 
 
 app = JsonFlask(__name__)
@@ -80,13 +235,79 @@ app.config.update(
     APPLICATION_ROOT="/api/",
 )
 
-
-stock_model = StockModel.load("/model/stock_lstm")
-
-
-# Load snapshot data from file
-with open("/data/snapshots.json") as f:
-    snapshots = json.load(f)
+# Instrumentation is opt-in. ISOMETRIC_SLOW_REQUEST_MS sets the
+# threshold for logging slow requests.
+if os.environ.get("ISOMETRIC_METRICS", "0") == "1":
+    slow_request_ms = os.environ.get("ISOMETRIC_SLOW_REQUEST_MS", None)
+    app.enable_metrics(db, float(slow_request_ms)/1000 if slow_request_ms else None)
+
+# Size in megabytes of the per-process response cache, 0 turns it off
+app.response_cache.max_bytes = int(float(os.environ.get("ISOMETRIC_RESPONSE_CACHE_MB", "64"))*1024*1024)
+# Cached responses are shared until the next write, so never fill them
+# from a replica that might not have that write yet
+app.primary_reads = db.primary_reads
+# Smallest response in bytes to compress, 0 compresses everything the
+# client accepts compressed and "off" turns compression off
+compress_min_bytes = os.environ.get("ISOMETRIC_COMPRESS_MIN_BYTES", "1024")
+app.compression_threshold = None if compress_min_bytes == "off" else int(compress_min_bytes)
+
+
+# Budget id -> id of the first budget in its chain. Entries are checked
+# against the database each time they are used, so stale ones are harmless.
+budget_chain_heads = Cache()
+
+# Budget changes made by any API process, pushed to event streams and
+# used to invalidate this process's cached responses
+budget_notifier = BudgetNotifier(db.dsn)
+app.add_invalidation_hook(lambda scopes: budget_notifier.publish(db,
+    [ALL_BUDGETS if scope is AllScopes else scope for scope in scopes]))
+budget_notifier.add_listener(lambda budget_id: app.response_cache.bump(
+    AllScopes if budget_id == ALL_BUDGETS else budget_id))
+
+
+# Versioned models, the newest of which serves predictions
+model_registry = ModelRegistry(MODEL_DIR, "stock_lstm")
+
+# Concurrent predictions are grouped into batches and run against
+# a stateless copy of whichever model is active
+prediction_batcher = MicroBatcher(lambda: model_registry.model)
+
+# Snapshot data from file
+snapshots = SnapshotStore(SNAPSHOTS_PATH)
+
+def sighup_handler(signum, frame):
+    # Loading could fail or wait on the lock, so leave it to the watcher
+    snapshots.request_reload()
+signal.signal(signal.SIGHUP, sighup_handler)
+
+
+# Startup work is done in the background once the server is started, so
+# it can accept connections right away. /ready reports the progress.
+def load_model():
+    model_registry.load_latest()
+    # Swap in newer versions as they are saved
+    model_registry.watch()
+
+def load_snapshots():
+    snapshots.load()
+    # Pick up any changes to the file automatically, or on SIGHUP
+    snapshots.watch()
+
+def load_revoked_tokens():
+    token_denylist.load()
+    # Pick up tokens revoked by other processes
+    token_denylist.watch()
+
+app.add_component("schema", db.validate_schema, required=True)
+app.add_component("snapshots", load_snapshots)
+app.add_component("model", load_model)
+
+# Signed tokens are checked without any lookup, apart from an in-memory
+# list of tokens revoked before they expire
+if TOKEN_KEYS:
+    token_denylist = TokenDenylist(db)
+    app.token_signer = TokenSigner(parse_keys(TOKEN_KEYS), int(TOKEN_HOURS*60*60), token_denylist)
+    app.add_component("revoked_tokens", load_revoked_tokens, required=True)
 
 
 # Database Functions
@@ -102,6 +323,13 @@ def budget_permissions(budget_id: int, user_id: int):
         return permissions
 
 
+def can_view_budget(arguments):
+    # For routes whose responses are shared by everyone who can view the budget
+    if budget_permissions(arguments["budget_id"], arguments["user_id"]) < Permissions.VIEW:
+        return {"error": "insufficient permissions"}, 403
+    return None
+
+
 def category_in_budget(category_id: int, budget_id: int):
     category_id = db.query_one("""
         SELECT category_id from categories
@@ -134,9 +362,8 @@ def register(username: str, password: str):
         "INSERT INTO users (user_name, user_pw_hash, user_pw_salt) VALUES (%s, %s, %s) RETURNING user_id;",
         (username, password_hash, salt)
     )
-    # Add user token to cache
-    user_token = secrets.token_urlsafe(16)
-    app.authtoken_cache[user_token] = user_id
+    # Issue the user a token
+    user_token = app.issue_token(user_id)
     # Return token and id
     return {"status": "success", "authtoken": user_token, "id": user_id}, 201
 
@@ -157,19 +384,24 @@ def login(username: str, password: str):
     # Determine if the hashes match
     if not compare_digest(correct_hash, given_hash):
         return {"error": "invalid credentials"}, 401
-    # Add user token to cache
-    user_token = secrets.token_urlsafe(16)
-    app.authtoken_cache[user_token] = user_id
+    # Issue the user a token
+    user_token = app.issue_token(user_id)
     # Return token and id
     return {"status": "success", "authtoken": user_token, "id": user_id}
 
 
 @app.json_route
-def status(user_id: UserId):
+def logout(user_id: UserId):
+    app.revoke_token(request.json['authtoken'])
     return {"status": "success"}
 
 
 @app.json_route
+def status(user_id: UserId):
+    return {"status": "success"}
+
+
+@app.json_route(invalidates="budget_id")
 def budget_permissions_set(user_id: UserId, budget_id: int,
         recipient_user_id: int, permissions: int):
     # Lookup permissions
@@ -225,7 +457,7 @@ def budget_permissions_get(auth_user_id: UserId, budget_id: int,
     return {"status": "success", "permissions": recipient_permissions}
 
 
-@app.json_route
+@app.json_route(invalidates="budget_id")
 def budget_permissions_transfer(user_id: UserId, budget_id: int,
         recipient_user_id: int):
     # Verify user is the owner of the budget
@@ -234,28 +466,31 @@ def budget_permissions_transfer(user_id: UserId, budget_id: int,
     # Verify the recipient is a real user
     if not is_valid_user_id(recipient_user_id):
         return {"error": "user does not exist"}, 400
-    # Remove owner privileges from the owner
-    db.execute("""
-        UPDATE budget_permissions SET permissions=%s
-        WHERE budget_id=%s AND user_id=%s;
-    """, (Permissions.ADMIN, budget_id, user_id))
-    # Grant owner privileges to the recipient
-    if budget_permissions(budget_id, recipient_user_id) == Permissions.NONE:
-        db.execute("""
-            INSERT INTO budget_permissions
-            (budget_id, user_id, permissions)
-            VALUES (%s, %s, %s);
-        """, (budget_id, recipient_user_id, Permissions.OWNER))
-    else:
+    # Swap owners in one transaction, so the budget is never left with
+    # no owner or two
+    with db.transaction():
+        # Remove owner privileges from the owner
         db.execute("""
             UPDATE budget_permissions SET permissions=%s
             WHERE budget_id=%s AND user_id=%s;
-        """, (Permissions.OWNER, budget_id, recipient_user_id))
+        """, (Permissions.ADMIN, budget_id, user_id))
+        # Grant owner privileges to the recipient
+        if budget_permissions(budget_id, recipient_user_id) == Permissions.NONE:
+            db.execute("""
+                INSERT INTO budget_permissions
+                (budget_id, user_id, permissions)
+                VALUES (%s, %s, %s);
+            """, (budget_id, recipient_user_id, Permissions.OWNER))
+        else:
+            db.execute("""
+                UPDATE budget_permissions SET permissions=%s
+                WHERE budget_id=%s AND user_id=%s;
+            """, (Permissions.OWNER, budget_id, recipient_user_id))
     # Return status
     return {"status": "success"}
 
 
-@app.json_route
+@app.json_route(invalidates="budget_id")
 def budget_permissions_relinquish(user_id: UserId, budget_id: int):
     # Get user permissions
     permissions = budget_permissions(budget_id, user_id)
@@ -275,43 +510,55 @@ def budget_permissions_relinquish(user_id: UserId, budget_id: int):
 
 
 
-@app.json_route
+@app.json_route(invalidates="previous_budget_id")
 def budget_create(user_id: UserId, budget_name: str,
         previous_budget_id: Optional[int]):
-    # Validate budget does not exist
-    budget_id = db.query_one("""
-        SELECT budget_id FROM budgets WHERE budget_name=%s;
-    """, (budget_name,))
-    if budget_id is not None:
-        return {"error": "budget exists"}, 400
-    # If previous budget, validate that budget has no child
+    # Create the budget, link it to the end of the previous budget's chain
+    # and make the creator the owner, all in one statement. Nothing is
+    # inserted if the name is taken or the previous budget has a child.
+    budget_id = db.execute_one("""
+        WITH new_budget AS (
+            INSERT INTO budgets (budget_name, previous_budget_id)
+            SELECT %(budget_name)s, %(previous_budget_id)s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM budgets WHERE budget_name=%(budget_name)s
+            ) AND NOT EXISTS (
+                SELECT 1 FROM budgets WHERE previous_budget_id=%(previous_budget_id)s
+            )
+            RETURNING budget_id, previous_budget_id
+        ), linked AS (
+            UPDATE budgets SET next_budget_id=new_budget.budget_id
+            FROM new_budget
+            WHERE budgets.budget_id=new_budget.previous_budget_id
+        ), owner AS (
+            INSERT INTO budget_permissions (budget_id, user_id, permissions)
+            SELECT budget_id, %(user_id)s, %(permissions)s FROM new_budget
+        )
+        SELECT budget_id FROM new_budget;
+    """, {
+        "budget_name": budget_name,
+        "previous_budget_id": previous_budget_id,
+        "user_id": user_id,
+        "permissions": Permissions.OWNER,
+    })
+    if budget_id is None:
+        # Work out which check failed
+        if db.query_one("""
+            SELECT budget_id FROM budgets WHERE budget_name=%s;
+        """, (budget_name,)) is not None:
+            return {"error": "budget exists"}, 400
+        return {"error": "parent budget has a child already"}, 400
+    # A child shares its parent's chain head
     if previous_budget_id:
-        existing_child_id = db.query_one("""
-            SELECT budget_id FROM budgets WHERE previous_budget_id=%s;
-        """, (previous_budget_id,))
-        if existing_child_id is not None:
-            return {"error": "parent budget has a child already"}, 400
-        
-    # Create budget
-    budget_id = db.execute_one(
-        "INSERT INTO budgets (budget_name, previous_budget_id) VALUES (%s, %s) RETURNING budget_id;",
-        (budget_name, previous_budget_id)
-    )
-    # Add next_budget_id to previous budget
-    db.execute("""
-        UPDATE budgets SET next_budget_id=%s
-        WHERE budget_id=%s;
-    """, (budget_id, previous_budget_id))
-    # Add owner permissions to creator
-    db.execute("""
-        INSERT INTO budget_permissions (budget_id, user_id, permissions)
-        VALUES (%s, %s, %s);
-    """, (budget_id, user_id, Permissions.OWNER))
+        head_id = budget_chain_heads[previous_budget_id]
+        if head_id is not None:
+            budget_chain_heads[budget_id] = head_id
     # Return status
     return {"status": "success", "id": budget_id}
 
 
-@app.json_route
+@app.json_route(invalidates="budget_id")
+@app.requires("snapshots")
 def budget_update(user_id: UserId, budget_id: int, budget_name: str, ticker_symbol: Optional[str]):
     # Validate permissions
     if budget_permissions(budget_id, user_id) < Permissions.UPDATE:
@@ -326,7 +573,7 @@ def budget_update(user_id: UserId, budget_id: int, budget_name: str, ticker_symb
     return {"status": "success"}
 
 
-@app.json_route
+@app.json_route(invalidates=AllScopes)
 def budget_delete(user_id: UserId, budget_id: int):
     # Validate permissions
     if budget_permissions(budget_id, user_id) < Permissions.ADMIN:
@@ -345,9 +592,12 @@ def budget_list(user_id: UserId):
     budgets = db.query("""
         SELECT  budgets.budget_id, budgets.budget_name, ticker_symbol,
                 budgets.previous_budget_id, budgets.next_budget_id,
-                budget_permissions.permissions
+                budget_permissions.permissions,
+                COALESCE(budget_totals.expense_total, 0::money),
+                COALESCE(budget_totals.expense_count, 0)
         FROM budgets JOIN budget_permissions
         ON budgets.budget_id=budget_permissions.budget_id
+        LEFT JOIN budget_totals ON budget_totals.budget_id=budgets.budget_id
         WHERE budget_permissions.user_id=%s
         ORDER BY budgets.budget_id;
     """, (user_id,))
@@ -359,14 +609,17 @@ def budget_list(user_id: UserId):
             "next_id": next_id,
             "name": name,
             "permissions": permissions,
-            "ticker_symbol": ticker_symbol
-        } for budget_id, name, ticker_symbol, previous_id, next_id, permissions in budgets
+            "ticker_symbol": ticker_symbol,
+            "total": total,
+            "expense_count": expense_count,
+        } for budget_id, name, ticker_symbol, previous_id, next_id,
+            permissions, total, expense_count in budgets
     ]
     # Return budgets
     return {"status": "success", "budgets": budgets}
 
 
-@app.json_route
+@app.json_route(cache="budget_id")
 def budget_info(user_id: UserId, budget_id: int):
     # Validate permissions
     if budget_permissions(budget_id, user_id) < Permissions.VIEW:
@@ -375,25 +628,168 @@ def budget_info(user_id: UserId, budget_id: int):
     info = db.query_one(
         """
             SELECT budget_name, ticker_symbol, previous_budget_id,
-                next_budget_id, permissions
+                next_budget_id, permissions,
+                COALESCE(budget_totals.expense_total, 0::money),
+                COALESCE(budget_totals.expense_count, 0)
             FROM budgets JOIN budget_permissions
             ON budgets.budget_id=budget_permissions.budget_id
+            LEFT JOIN budget_totals ON budget_totals.budget_id=budgets.budget_id
             WHERE budgets.budget_id=%s AND budget_permissions.user_id=%s
         """,
         (budget_id, user_id)
     )
     if info is None:
         return {"error": "budget does not exist"}, 400
-    name, ticker_symbol, previous_id, next_id, permissions = info
+    name, ticker_symbol, previous_id, next_id, permissions, total, expense_count = info
     # Return info
     return {
         "status": "success", "name": name, "permissions": permissions,
         "ticker_symbol": ticker_symbol,
         "previous_id": previous_id, "next_id": next_id,
+        "total": total, "expense_count": expense_count,
     }
 
 
+# Walks back from %(start_id)s to the head of its chain, then forward over
+# the whole chain. Starting from the head itself skips straight to the
+# forward walk. Queries continue on from here with further CTEs.
+BUDGET_CHAIN_SQL = """
+WITH RECURSIVE ancestors AS (
+    SELECT budget_id, previous_budget_id
+    FROM budgets WHERE budget_id=%(start_id)s
+    UNION ALL
+    SELECT budgets.budget_id, budgets.previous_budget_id
+    FROM budgets JOIN ancestors
+    ON budgets.budget_id=ancestors.previous_budget_id
+), chain AS (
+    SELECT budget_id AS head_id, budget_id, next_budget_id, 0 AS position
+    FROM budgets WHERE budget_id=(
+        SELECT budget_id FROM ancestors WHERE previous_budget_id IS NULL
+    )
+    UNION ALL
+    SELECT chain.head_id, budgets.budget_id, budgets.next_budget_id, chain.position + 1
+    FROM budgets JOIN chain
+    ON budgets.budget_id=chain.next_budget_id
+)
+"""
+
+
+def query_budget_chain(start_id: int, user_id: int):
+    """
+    Return each budget the user can view in start_id's chain, with the
+    total of each of its categories.
+    """
+    return db.query(BUDGET_CHAIN_SQL + """
+        SELECT  chain.head_id, budgets.budget_id, budgets.budget_name, budgets.ticker_symbol,
+                budgets.previous_budget_id, budgets.next_budget_id,
+                budget_permissions.permissions,
+                COALESCE(budget_totals.expense_total, 0::money),
+                categories.category_id, categories.category_name,
+                COALESCE(category_totals.expense_total, 0::money)
+        FROM chain
+        JOIN budgets ON budgets.budget_id=chain.budget_id
+        JOIN budget_permissions
+        ON budget_permissions.budget_id=chain.budget_id
+        AND budget_permissions.user_id=%(user_id)s
+        AND budget_permissions.permissions>=%(permissions)s
+        LEFT JOIN budget_totals ON budget_totals.budget_id=chain.budget_id
+        LEFT JOIN categories ON categories.budget_id=chain.budget_id
+        LEFT JOIN category_totals
+        ON category_totals.category_id=categories.category_id
+        ORDER BY chain.position, categories.category_id;
+    """, {"start_id": start_id, "user_id": user_id, "permissions": Permissions.VIEW})
+
+
 @app.json_route
+def budget_chain(user_id: UserId, budget_id: int):
+    # Validate permissions
+    if budget_permissions(budget_id, user_id) < Permissions.VIEW:
+        return {"error": "insufficient permissions"}, 403
+    # Start from the cached head of the chain if there is one. Budgets
+    # can't be added in front of a head, so the head is only out of date
+    # if it was deleted, in which case this budget won't be in its chain.
+    head_id = budget_chain_heads[budget_id]
+    rows = query_budget_chain(head_id, user_id) if head_id is not None else None
+    if not rows or all(row[1] != budget_id for row in rows):
+        rows = query_budget_chain(budget_id, user_id)
+    # Group category rows under their budgets
+    budgets = []
+    for (head_id, chain_budget_id, name, ticker_symbol, previous_id, next_id,
+            permissions, total, category_id, category_name, category_total) in rows:
+        if not budgets or budgets[-1]["id"] != chain_budget_id:
+            budgets.append({
+                "id": chain_budget_id,
+                "previous_id": previous_id,
+                "next_id": next_id,
+                "name": name,
+                "permissions": permissions,
+                "ticker_symbol": ticker_symbol,
+                "total": total,
+                "categories": [],
+            })
+        if category_id is not None:
+            budgets[-1]["categories"].append({
+                "id": category_id,
+                "name": category_name,
+                "total": category_total,
+            })
+    # Remember the head for every budget in the chain
+    for budget in budgets:
+        budget_chain_heads[budget["id"]] = head_id
+    # Return chain
+    return {"status": "success", "budgets": budgets}
+
+
+@app.json_route
+def budget_events_token(user_id: UserId, budget_id: int):
+    # Validate permissions
+    if budget_permissions(budget_id, user_id) < Permissions.VIEW:
+        return {"error": "insufficient permissions"}, 403
+    token = app.issue_scoped_token(user_id, f"budget_events:{budget_id}")
+    return {"status": "success", "token": token}
+
+
+@app.route('/budget/events', methods=['GET'])
+def budget_events():
+    # Browsers can't send a body with EventSource, so this takes the budget
+    # id and a short-lived token from /budget/events/token, which can't be
+    # used for anything but this stream, as query parameters
+    budget_id = request.args.get('budget_id', None, type=int)
+    if budget_id is None:
+        return {"error": "invalid budget id"}, 400
+    user_id = app.authenticate(request.args.get('token', None), f"budget_events:{budget_id}")
+    if user_id is None:
+        return {"error": "login required"}, 401
+    # Validate permissions
+    if budget_permissions(budget_id, user_id) < Permissions.VIEW:
+        return {"error": "insufficient permissions"}, 403
+    # Clients poll instead if changes can't be pushed to them
+    if not budget_notifier.connected:
+        return {"error": "budget notifications are not available"}, 503
+    subscription = budget_notifier.subscribe([budget_id], limit=EVENT_STREAMS)
+    if subscription is None:
+        return {"error": "too many event streams"}, 503
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            closes_at = time.monotonic() + EVENT_STREAM_SECONDS
+            while time.monotonic() < closes_at:
+                try:
+                    subscription.get(timeout=15)
+                except queue.Empty:
+                    # Comment line, so dead connections are noticed
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: change\ndata: {json.dumps({'budget_id': budget_id})}\n\n"
+        finally:
+            budget_notifier.unsubscribe(subscription)
+
+    return Response(stream(), mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.json_route(invalidates="budget_id")
 def category_create(user_id: UserId, budget_id: int, category_name: str):
     # Validate permissions
     if budget_permissions(budget_id, user_id) < Permissions.UPDATE:
@@ -414,7 +810,7 @@ def category_create(user_id: UserId, budget_id: int, category_name: str):
     return {"status": "success", "id": category_id}
 
 
-@app.json_route
+@app.json_route(invalidates="budget_id")
 def category_update(user_id: UserId, budget_id: int,
         category_id: int, category_name: str):
     # Validate permissions
@@ -429,7 +825,7 @@ def category_update(user_id: UserId, budget_id: int,
     return {"status": "success"}
 
 
-@app.json_route
+@app.json_route(invalidates="budget_id")
 def category_delete(user_id: UserId, budget_id: int, category_id: int):
     # Validate permissions
     if budget_permissions(budget_id, user_id) < Permissions.ADMIN:
@@ -442,45 +838,59 @@ def category_delete(user_id: UserId, budget_id: int, category_id: int):
     return {"status": "success"}
 
 
-@app.json_route
+@app.json_route(cache="budget_id")
 def category_list(user_id: UserId, budget_id: int):
     # Validate permissions
     if budget_permissions(budget_id, user_id) < Permissions.VIEW:
         return {"error": "insufficient permissions"}, 403
     # Query for categories
     categories = db.query("""
-        SELECT category_id, category_name
-        FROM categories WHERE budget_id=%s
-        ORDER BY category_id;
+        SELECT  categories.category_id, category_name,
+                COALESCE(category_totals.expense_total, 0::money),
+                COALESCE(category_totals.expense_count, 0)
+        FROM categories LEFT JOIN category_totals
+        ON category_totals.category_id=categories.category_id
+        WHERE budget_id=%s
+        ORDER BY categories.category_id;
     """, (budget_id,))
     # Transform tuples into dictionaries
     categories = [
         {
             "id": category_id,
             "name": category_name,
-        } for category_id, category_name in categories
+            "total": total,
+            "expense_count": expense_count,
+        } for category_id, category_name, total, expense_count in categories
     ]
     # Return categories
     return {"status": "success", "categories": categories}
 
 
-@app.json_route
+@app.json_route(cache="budget_id")
 def category_info(user_id: UserId, budget_id: int, category_id: int):
     # Validate permissions
     if budget_permissions(budget_id, user_id) < Permissions.VIEW:
         return {"error": "insufficient permissions"}, 403
     # Get category info
-    name = db.query_one("""
-        SELECT category_name FROM categories
-        WHERE budget_id=%s AND category_id=%s;
+    info = db.query_one("""
+        SELECT  category_name,
+                COALESCE(category_totals.expense_total, 0::money),
+                COALESCE(category_totals.expense_count, 0)
+        FROM categories LEFT JOIN category_totals
+        ON category_totals.category_id=categories.category_id
+        WHERE budget_id=%s AND categories.category_id=%s;
     """, (budget_id, category_id))
-    if name is None:
+    if info is None:
         return {"error": "category does not exist"}, 400
+    name, total, expense_count = info
     # Return info
-    return {"status": "success", "name": name}
+    return {
+        "status": "success", "name": name,
+        "total": total, "expense_count": expense_count,
+    }
 
 
-@app.json_route
+@app.json_route(invalidates="budget_id")
 def expense_create(user_id: UserId, budget_id: int, category_id: int,
         description: str, expense_amount: Money, expense_date: DateStr):
     # Validate permissions
@@ -509,7 +919,7 @@ def expense_create(user_id: UserId, budget_id: int, category_id: int,
     return {"status": "success", "id": expense_id}
 
 
-@app.json_route
+@app.json_route(invalidates="budget_id")
 def expense_update(user_id: UserId, budget_id: int,
         category_id: int, expense_id: int,
         description: str, expense_amount: Money, expense_date: DateStr):
@@ -540,7 +950,7 @@ def expense_update(user_id: UserId, budget_id: int,
     }
 
 
-@app.json_route
+@app.json_route(invalidates="budget_id")
 def expense_delete(user_id: UserId, budget_id: int,
         category_id: int, expense_id: int):
     # Validate permissions
@@ -557,7 +967,7 @@ def expense_delete(user_id: UserId, budget_id: int,
     return {"status": "success"}
 
 
-@app.json_route
+@app.json_route(cache="budget_id")
 def expense_info(user_id: UserId, budget_id: int, category_id: int,
         expense_id: int):
     # Validate permissions
@@ -583,21 +993,22 @@ def expense_info(user_id: UserId, budget_id: int, category_id: int,
     }
 
 
-@app.json_route
-def expense_list(user_id: UserId, budget_id: int, category_id: int):
-    # Validate permissions
-    if budget_permissions(budget_id, user_id) < Permissions.VIEW:
-        return {"error": "insufficient permissions"}, 403
+@app.json_route(cache="budget_id", shared=True, authorize=can_view_budget, single_flight=True)
+def expense_list(user_id: UserId, budget_id: int, category_id: int,
+        start_date: OptionalDateStr, end_date: OptionalDateStr):
     # Validate the given category belongs to the given budget
     if not category_in_budget(category_id, budget_id):
         return {"error": "budget category does not exist"}, 400
-    # Query for expenses
+    # Query for expenses, only scanning the partitions of the date range
+    # if one is given
     expenses = db.query("""
         SELECT  expense_id, expense_description, expense_amount,
                 expense_date
-        FROM expenses WHERE category_id=%s
+        FROM expenses WHERE category_id=%(category_id)s
+        AND (%(start_date)s::date IS NULL OR expense_date>=%(start_date)s::date)
+        AND (%(end_date)s::date IS NULL OR expense_date<=%(end_date)s::date)
         ORDER BY expense_date, expense_id;
-    """, (category_id,))
+    """, {"category_id": category_id, "start_date": start_date, "end_date": end_date})
     # Transform tuples into dictionaries
     expenses = [
         {
@@ -612,28 +1023,259 @@ def expense_list(user_id: UserId, budget_id: int, category_id: int):
     return {"status": "success", "expenses": expenses}
 
 
+# Largest page of /expense/search results
+SEARCH_PAGE_SIZE = 100
+
+
 @app.json_route
+def expense_search(user_id: UserId, query: str,
+        min_amount: OptionalMoney, max_amount: OptionalMoney,
+        start_date: OptionalDateStr, end_date: OptionalDateStr,
+        page: Optional[int], page_size: Optional[int]):
+    # Validate pagination
+    page = 1 if page is None else page
+    page_size = 20 if page_size is None else page_size
+    if page < 1 or not 1 <= page_size <= SEARCH_PAGE_SIZE:
+        return {"error": f"page must be at least 1 and page_size from 1 to {SEARCH_PAGE_SIZE}"}, 400
+    query = query.strip()
+    if not query:
+        return {"error": "empty search query"}, 400
+    # Match descriptions by words or as a substring, in every budget the
+    # user can view. Word matches rank first.
+    pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    start = time.perf_counter()
+    rows = db.query("""
+        WITH matches AS (
+            SELECT  expenses.expense_id, expenses.category_id,
+                    categories.budget_id, expenses.expense_description,
+                    expenses.expense_amount, expenses.expense_date,
+                    ts_rank(to_tsvector('english', expenses.expense_description),
+                        websearch_to_tsquery('english', %(query)s)) AS rank
+            FROM expenses
+            JOIN categories ON categories.category_id=expenses.category_id
+            JOIN budget_permissions
+            ON budget_permissions.budget_id=categories.budget_id
+            AND budget_permissions.user_id=%(user_id)s
+            AND budget_permissions.permissions>=%(permissions)s
+            WHERE (to_tsvector('english', expenses.expense_description)
+                    @@ websearch_to_tsquery('english', %(query)s)
+                OR expenses.expense_description ILIKE %(pattern)s)
+            AND (%(min_amount)s::numeric IS NULL OR expenses.expense_amount>=%(min_amount)s::numeric::money)
+            AND (%(max_amount)s::numeric IS NULL OR expenses.expense_amount<=%(max_amount)s::numeric::money)
+            AND (%(start_date)s::date IS NULL OR expenses.expense_date>=%(start_date)s::date)
+            AND (%(end_date)s::date IS NULL OR expenses.expense_date<=%(end_date)s::date)
+        )
+        SELECT  expense_id, category_id, budget_id, expense_description,
+                expense_amount, expense_date, rank, COUNT(*) OVER ()
+        FROM matches
+        ORDER BY rank DESC, expense_date DESC, expense_id DESC
+        LIMIT %(limit)s OFFSET %(offset)s;
+    """, {
+        "user_id": user_id, "permissions": Permissions.VIEW,
+        "query": query, "pattern": pattern,
+        "min_amount": min_amount, "max_amount": max_amount,
+        "start_date": start_date, "end_date": end_date,
+        "limit": page_size, "offset": (page - 1)*page_size,
+    })
+    query_ms = (time.perf_counter() - start)*1000
+    # Transform tuples into dictionaries
+    expenses = [
+        {
+            "id": expense_id,
+            "category_id": category_id,
+            "budget_id": budget_id,
+            "description": expense_description,
+            "amount": str(expense_amount),
+            "date": expense_date.isoformat(),
+            "rank": rank,
+        } for expense_id, category_id, budget_id, expense_description, \
+            expense_amount, expense_date, rank, _ in rows
+    ]
+    # Return the page, and how many matches there are in all
+    return {
+        "status": "success", "expenses": expenses,
+        "total": rows[0][-1] if rows else 0,
+        "page": page, "page_size": page_size,
+        "query_ms": round(query_ms, 2),
+    }
+
+
+# Each budget the user can view in the chain, and the monthly totals of
+# their categories within an optional date range. Dates are rounded to
+# whole months, as that is how the totals are kept.
+ANALYTICS_SQL = BUDGET_CHAIN_SQL + """
+, viewable AS (
+    SELECT chain.position, budgets.budget_id, budgets.budget_name
+    FROM chain
+    JOIN budgets ON budgets.budget_id=chain.budget_id
+    JOIN budget_permissions
+    ON budget_permissions.budget_id=chain.budget_id
+    AND budget_permissions.user_id=%(user_id)s
+    AND budget_permissions.permissions>=%(permissions)s
+), monthly AS (
+    SELECT  viewable.budget_id, categories.category_name,
+            category_monthly_totals.month, category_monthly_totals.expense_total
+    FROM viewable
+    JOIN categories ON categories.budget_id=viewable.budget_id
+    JOIN category_monthly_totals
+    ON category_monthly_totals.category_id=categories.category_id
+    WHERE category_monthly_totals.expense_count>0
+    AND (%(start_date)s::date IS NULL
+        OR category_monthly_totals.month>=date_trunc('month', %(start_date)s::date))
+    AND (%(end_date)s::date IS NULL
+        OR category_monthly_totals.month<=%(end_date)s::date)
+)
+"""
+
+
+def analytics_params(user_id, budget_id, start_date, end_date):
+    return {
+        "start_id": budget_id, "user_id": user_id,
+        "permissions": Permissions.VIEW,
+        "start_date": start_date, "end_date": end_date,
+    }
+
+
+@app.json_route
+def analytics_compare(user_id: UserId, budget_id: int,
+        start_date: OptionalDateStr, end_date: OptionalDateStr):
+    # Validate permissions
+    if budget_permissions(budget_id, user_id) < Permissions.VIEW:
+        return {"error": "insufficient permissions"}, 403
+    # Total each category by name in every budget of the chain, filling in
+    # zeros where a budget lacks a category, and compare each total with
+    # the same one in the previous budget
+    rows = db.query(ANALYTICS_SQL + """
+        , names AS (
+            SELECT DISTINCT category_name FROM categories
+            JOIN viewable ON viewable.budget_id=categories.budget_id
+        ), totals AS (
+            SELECT  viewable.position, viewable.budget_id, viewable.budget_name,
+                    names.category_name,
+                    COALESCE(SUM(monthly.expense_total), 0::money) AS total
+            FROM viewable LEFT JOIN names ON TRUE
+            LEFT JOIN monthly
+            ON monthly.budget_id=viewable.budget_id
+            AND monthly.category_name=names.category_name
+            GROUP BY viewable.position, viewable.budget_id,
+                viewable.budget_name, names.category_name
+        ), compared_totals AS (
+            SELECT position, SUM(total) AS total FROM totals GROUP BY position
+        )
+        SELECT  totals.budget_id, totals.budget_name,
+                compared_totals.total,
+                compared_totals.total - LAG(compared_totals.total)
+                    OVER (PARTITION BY totals.category_name ORDER BY totals.position),
+                totals.category_name, totals.total,
+                totals.total - LAG(totals.total)
+                    OVER (PARTITION BY totals.category_name ORDER BY totals.position)
+        FROM totals JOIN compared_totals ON compared_totals.position=totals.position
+        ORDER BY totals.position, totals.category_name;
+    """, analytics_params(user_id, budget_id, start_date, end_date))
+    # Group category rows under their budgets
+    budgets = []
+    for (chain_budget_id, name, total, delta,
+            category_name, category_total, category_delta) in rows:
+        if not budgets or budgets[-1]["id"] != chain_budget_id:
+            budgets.append({
+                "id": chain_budget_id,
+                "name": name,
+                "total": total,
+                "delta": delta,
+                "categories": [],
+            })
+        if category_name is not None:
+            budgets[-1]["categories"].append({
+                "name": category_name,
+                "total": category_total,
+                "delta": category_delta,
+            })
+    # Return comparison
+    return {"status": "success", "budgets": budgets}
+
+
+@app.json_route
+def analytics_trend(user_id: UserId, budget_id: int,
+        start_date: OptionalDateStr, end_date: OptionalDateStr):
+    # Validate permissions
+    if budget_permissions(budget_id, user_id) < Permissions.VIEW:
+        return {"error": "insufficient permissions"}, 403
+    # Total each category by name and month over the whole chain, filling
+    # in months with no expenses, and compare each month with the last
+    rows = db.query(ANALYTICS_SQL + """
+        , months AS (
+            SELECT generate_series(MIN(month), MAX(month), '1 month')::date AS month
+            FROM monthly
+        ), names AS (
+            SELECT DISTINCT category_name FROM monthly
+        ), totals AS (
+            SELECT  months.month, names.category_name,
+                    COALESCE(SUM(monthly.expense_total), 0::money) AS total
+            FROM months CROSS JOIN names
+            LEFT JOIN monthly
+            ON monthly.month=months.month
+            AND monthly.category_name=names.category_name
+            GROUP BY months.month, names.category_name
+        )
+        SELECT  month, category_name, total,
+                total - LAG(total) OVER (PARTITION BY category_name ORDER BY month)
+        FROM totals
+        ORDER BY category_name, month;
+    """, analytics_params(user_id, budget_id, start_date, end_date))
+    # Collect a series for each category
+    months = []
+    categories = []
+    for month, category_name, total, delta in rows:
+        if not categories or categories[-1]["name"] != category_name:
+            categories.append({"name": category_name, "totals": [], "deltas": []})
+        if len(categories) == 1:
+            months.append(month.isoformat())
+        categories[-1]["totals"].append(total)
+        categories[-1]["deltas"].append(delta)
+    # Return trend
+    return {"status": "success", "months": months, "categories": categories}
+
+
+@app.json_route(cache=lambda arguments: ("snapshots", snapshots.version), shared=True)
+@app.requires("snapshots")
 def symbols(user_id: UserId):
     return {"status": "success", "symbols": list(snapshots.keys())}
 
 
-@app.json_route
+@app.json_route(cache=lambda arguments: ("snapshots", snapshots.version), shared=True,
+        single_flight=True)
+@app.requires("snapshots")
 def symbol_values(user_id: UserId, ticker_symbol: str):
-    if ticker_symbol not in snapshots:
+    values = snapshots.get(ticker_symbol)
+    if values is None:
         return {"error": "unrecognized ticker symbol"}, 400
     return {
         "status": "success",
-        "values": snapshots[ticker_symbol],
-        "labels": list(range(1, len(snapshots[ticker_symbol])+1))
+        "values": values,
+        "labels": list(range(1, len(values)+1))
     }
 
 
 @app.json_route
+@app.requires("model")
+def model_version(user_id: UserId):
+    return {
+        "status": "success",
+        "version": model_registry.version,
+        "loaded_at": model_registry.loaded_at.isoformat()
+    }
+
+
+# Predictions only depend on the values and the model version, so a swap
+# leaves the shared and in-flight predictions of the old model behind
+@app.json_route(cache=lambda arguments: [("model", model_registry.version)], shared=True,
+        single_flight=True)
+@app.requires("model")
 def model_predict(user_id: UserId, values: list):
     try:
         return {
             "status": "success",
-            "value": stock_model.predict(values)
+            "value": prediction_batcher.predict(values)
         }
     except (TypeError, ValueError) as e:
         raise e
@@ -643,4 +1285,6 @@ def model_predict(user_id: UserId, values: list):
 # Start UWSGI server
 if __name__ == '__main__':
     import waitress
-    waitress.serve(app, host='0.0.0.0', port=80)
+    app.start_components()
+    budget_notifier.start()
+    waitress.serve(app, host='0.0.0.0', port=PORT, threads=THREADS)
@@ -0,0 +1,73 @@
+import numpy
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from model import standardize_array
+
+
+class MicroBatcher:
+    """
+    Collects concurrent prediction requests into batches. The first
+    request to arrive waits up to max_delay seconds for others to join it,
+    then the whole batch runs through the model's predict_batch() in one
+    pass and each caller gets its own result back.
+    """
+    def __init__(self, get_model, max_batch_size=32, max_delay=0.005):
+        self.get_model = get_model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def predict(self, input_sequence):
+        input_sequence = validate_sequence(input_sequence)
+        future = Future()
+        self.queue.put((input_sequence, future))
+        return future.result()
+
+    def next_batch(self):
+        # Block until there is at least one request
+        batch = [self.queue.get()]
+        # Then gather up whatever else arrives before the deadline
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            input_sequences = [input_sequence for input_sequence, _ in batch]
+            try:
+                results = self.get_model().predict_batch(input_sequences)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+def validate_sequence(input_sequence):
+    """
+    Convert a request's sequence to the float32 array the model works on,
+    raising TypeError or ValueError in the caller's thread if it can't be
+    predicted on. This is the only conversion the sequence goes through.
+    """
+    arr = standardize_array(input_sequence)
+    if arr.ndim != 1:
+        raise ValueError("sequence must be one dimensional")
+    if len(arr) < 2:
+        raise ValueError("sequence must have at least two values")
+    if not numpy.isfinite(arr).all():
+        raise ValueError("sequence values must be finite")
+    return arr
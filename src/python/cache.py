@@ -21,4 +21,8 @@ class Cache:
     
     def __setitem__(self, key, value):
         self.check_timeout()
-        self.cache[key] = value
\ No newline at end of file
+        self.cache[key] = value
+
+    def pop(self, key):
+        self.check_timeout()
+        return self.cache.pop(key, None)
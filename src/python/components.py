@@ -0,0 +1,48 @@
+import threading
+import time
+
+
+class Component:
+    """
+    A part of the application that is initialized in a background thread
+    so the server can start accepting connections right away. If
+    initialization fails it is retried every retry_interval seconds until
+    it succeeds.
+    """
+    def __init__(self, name, initialize, required=False, retry_interval=5):
+        self.name = name
+        self.initialize = initialize
+        self.required = required
+        self.retry_interval = retry_interval
+        self.ready = False
+        self.error = None
+        self.ready_at = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"init-{self.name}", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def run(self):
+        started_at = time.monotonic()
+        while True:
+            try:
+                self.initialize()
+            except Exception as e:
+                self.error = f"{type(e).__name__}: {e}"
+                print(f"Failed to initialize {self.name}, retrying in {self.retry_interval}s: {self.error}")
+                time.sleep(self.retry_interval)
+            else:
+                self.error = None
+                self.ready_at = time.monotonic() - started_at
+                self.ready = True
+                print(f"Initialized {self.name} in {self.ready_at:.2f}s")
+                return
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "error": self.error,
+            "seconds_to_ready": self.ready_at,
+        }
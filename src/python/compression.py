@@ -0,0 +1,34 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Content codings the API can send, best first
+if brotli is not None:
+    ENCODINGS = {
+        "br": lambda data: brotli.compress(data, quality=5),
+        "gzip": lambda data: gzip.compress(data, compresslevel=6),
+    }
+else:
+    ENCODINGS = {
+        "gzip": lambda data: gzip.compress(data, compresslevel=6),
+    }
+
+
+def negotiate_encoding(accept_encodings):
+    """
+    Pick the content coding to use for a request's Accept-Encoding
+    header, or None to send the response uncompressed.
+    """
+    encoding = accept_encodings.best_match(ENCODINGS.keys())
+    # best_match() falls back on a wildcard, which may allow identity only
+    if encoding is None or accept_encodings[encoding] == 0:
+        return None
+    return encoding
+
+
+def compress(data, encoding):
+    return ENCODINGS[encoding](data)
@@ -0,0 +1,156 @@
+import json
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def load_differences(path, chunk_size=256, length=None):
+    """
+    Load the snapshot store at path and return the step differences of
+    every symbol as one (symbols, length - 1) float32 array.
+
+    The store is streamed one symbol at a time, twice: once for the series
+    lengths and once to fill the array, chunk_size symbols at a time. Only
+    one symbol's Python floats are held alongside the array. length is by
+    default the median series length, so a few short series, such as newly
+    added symbols, don't cut everyone else's history short. Longer series
+    keep their most recent values and shorter ones are left out, and both
+    are logged.
+    """
+    lengths = {symbol: len(values) for symbol, values in iter_snapshots(path)}
+    if length is None:
+        usable = sorted(n for n in lengths.values() if n >= 2)
+        length = usable[(len(usable) - 1) // 2] if usable else 2
+    if length < 2:
+        raise ValueError(f"series length must be at least 2, not {length}")
+    dropped = [symbol for symbol, n in lengths.items() if n < length]
+    truncated = [symbol for symbol, n in lengths.items() if n > length]
+    if dropped:
+        print(f"Dropped {len(dropped)} series shorter than {length} values: {', '.join(dropped)}")
+    if truncated:
+        print(f"Truncated {len(truncated)} series to their last {length} values: {', '.join(truncated)}")
+    count = len(lengths) - len(dropped)
+
+    # Allocate the output once and fill it a chunk at a time
+    result = numpy.empty((count, length - 1), dtype=numpy.float32)
+    chunk = numpy.empty((chunk_size, length), dtype=numpy.float32)
+    filled = 0
+    row = 0
+    for _, values in iter_snapshots(path):
+        if len(values) < length:
+            continue
+        chunk[row] = values[-length:]
+        row += 1
+        if row == chunk_size:
+            differences(chunk, out=result[filled:filled + row])
+            filled += row
+            row = 0
+    differences(chunk[:row], out=result[filled:filled + row])
+    return result
+
+
+def iter_snapshots(path, block_size=1 << 16):
+    """
+    Yield the (symbol, values) pairs of the snapshot store at path in file
+    order, parsing one pair at a time instead of the whole store.
+    """
+    with open(path) as f:
+        reader = _JsonObjectReader(f, block_size)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            symbol = reader.value()
+            reader.expect(":")
+            yield symbol, reader.value()
+            if reader.expect(",}") == "}":
+                return
+
+
+class _JsonObjectReader:
+    """
+    Reads the members of a JSON object from a file a block at a time.
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f, block_size):
+        self.f = f
+        self.block_size = block_size
+        self.buffer = ""
+        self.position = 0
+
+    def read(self):
+        # Grow reads with the buffer, so a value spanning many blocks is
+        # decoded a bounded number of times
+        block = self.f.read(max(self.block_size, len(self.buffer) - self.position))
+        self.buffer = self.buffer[self.position:] + block
+        self.position = 0
+        return bool(block)
+
+    def peek(self):
+        """
+        The next character that isn't whitespace, or "" at the end of the file.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read():
+                return ""
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"expected one of '{characters}' in snapshot store, got '{character}'")
+        self.position += 1
+        return character
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # The value may continue in the next block
+                if not self.read():
+                    raise
+                continue
+            self.position = end
+            return value
+
+
+def differences(series, out=None):
+    """
+    Returns the difference between each value and the value before it,
+    along the last axis of series.
+    """
+    series = numpy.asarray(series, dtype=numpy.float32)
+    if out is None:
+        out = numpy.empty(series.shape[:-1] + (series.shape[-1] - 1,), dtype=numpy.float32)
+    numpy.subtract(series[..., 1:], series[..., :-1], out=out)
+    return out
+
+
+def sliding_windows(data, window, stride=1):
+    """
+    Returns every window of length window along the last axis of a 2D
+    array, taken every stride steps, as a (windows, window) array.
+    """
+    windows = sliding_window_view(data, window, axis=-1)[:, ::stride]
+    return windows.reshape(-1, window)
+
+
+def split_input_output(data):
+    """
+    Split sequences into model inputs and the value that follows each input.
+    """
+    return data[..., :-1], data[..., 1:]
+
+
+def train_test_split(data, fraction=0.8):
+    """
+    Split sequences by timestep, with the first fraction of every sequence
+    used for training and the rest used for testing.
+    """
+    cutoff = int(fraction * data.shape[-1])
+    return data[..., :cutoff], data[..., cutoff:]
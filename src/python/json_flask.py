@@ -1,16 +1,208 @@
+import contextlib
 import functools
 import inspect
+import json
+import secrets
+import time
 from datetime import date
 from inspect import Signature, Parameter
-from flask import Flask, abort, request, jsonify
+from flask import Flask, Response, abort, g, has_request_context, request, jsonify
 from cache import Cache
+from components import Component
+from compression import compress, negotiate_encoding
+from metrics import Metrics
+from response_cache import AllScopes, ResponseCache, body_etag
+from single_flight import SingleFlight
 from typing import Union, get_origin, get_args
+from werkzeug.exceptions import HTTPException
+
+
+# Buckets for counting database round trips per request
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# Buckets for counting requests that shared one single-flight response
+SINGLE_FLIGHT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
 
 
 class JsonFlask(Flask):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.authtoken_cache = Cache()
+        # Unsigned scoped tokens -> (user id, scope, expiry time)
+        self.scoped_token_cache = Cache()
+        # Signs stateless auth tokens if set, otherwise tokens are random
+        # and only valid in the process that issued them
+        self.token_signer = None
+        # Instrumentation, off until enable_metrics() is called
+        self.metrics = Metrics()
+        self.metrics.describe("request_seconds", "histogram",
+            "Time spent in each phase of a JSON request.")
+        self.metrics.describe("request_db_seconds", "histogram",
+            "Time spent waiting on the database per request.")
+        self.metrics.describe("request_db_queries", "histogram",
+            "Database round trips per request.")
+        self.metrics.describe("responses_total", "counter",
+            "Responses sent, by route and status code.")
+        self.metrics.describe("response_cache_total", "counter",
+            "Response cache lookups, by route and whether they hit.")
+        self.metrics.describe("response_cache_bytes", "gauge",
+            "Size of the cached response bodies.")
+        self.metrics.gauge("response_cache_bytes", lambda: self.response_cache.size)
+        self.metrics.describe("single_flight_total", "counter",
+            "Single-flight requests, by route and whether they ran the route or waited.")
+        self.metrics.describe("single_flight_callers", "histogram",
+            "Requests served by each single-flight run of a route.")
+        self.slow_request_threshold = None
+        self.add_url_rule('/metrics', 'metrics', self.metrics_endpoint)
+        # Encoded responses of routes declared with cache=
+        self.response_cache = ResponseCache()
+        # Smallest response body worth compressing, None turns it off
+        self.compression_threshold = 1024
+        # Called with the scopes each invalidates= route changed
+        self.invalidation_hooks = []
+        # Context manager the handlers filling cache entries run in, so
+        # they can read from somewhere that isn't behind the last write
+        self.primary_reads = contextlib.nullcontext
+        # Identical requests running right now, for single_flight= routes
+        self.single_flight = SingleFlight()
+        # Parts of the app initialized in the background
+        self.components = {}
+        self.add_url_rule('/ready', 'ready', self.ready_endpoint)
+
+    def issue_token(self, user_id):
+        if self.token_signer is not None:
+            return self.token_signer.issue(user_id)
+        token = secrets.token_urlsafe(16)
+        self.authtoken_cache[token] = user_id
+        return token
+
+    def issue_scoped_token(self, user_id, scope, lifetime=60):
+        """
+        A short-lived token that only authenticates the given scope, for
+        places a token can leak from, such as URLs.
+        """
+        if self.token_signer is not None:
+            return self.token_signer.issue(user_id, scope, lifetime)
+        token = secrets.token_urlsafe(16)
+        self.scoped_token_cache[token] = (user_id, scope, time.monotonic() + lifetime)
+        return token
+
+    def authenticate(self, token, scope=None):
+        """
+        The id of the user a token was issued to, or None if it isn't
+        valid. Scoped tokens are only valid when given the same scope.
+        """
+        if self.token_signer is not None and self.token_signer.looks_signed(token):
+            return self.token_signer.verify(token, scope)
+        if scope is not None:
+            issued = self.scoped_token_cache[token]
+            if issued is None or issued[1] != scope or issued[2] <= time.monotonic():
+                return None
+            return issued[0]
+        # Tokens issued before signing was turned on keep working until
+        # they time out
+        return self.authtoken_cache[token]
+
+    def revoke_token(self, token):
+        if self.token_signer is not None and self.token_signer.looks_signed(token):
+            claims = self.token_signer.claims(token)
+            if claims is not None:
+                _, _, expires_at, signature = claims
+                self.token_signer.denylist.revoke(signature, expires_at)
+        else:
+            self.authtoken_cache.pop(token)
+
+    def add_component(self, name, initialize, required=False, retry_interval=5):
+        """
+        Register a component to be initialized in the background by
+        start_components(). Every JSON route returns 503 until required
+        components are ready, other components can be waited on by
+        individual routes with @app.requires().
+        """
+        component = Component(name, initialize, required, retry_interval)
+        self.components[name] = component
+        return component
+
+    def add_invalidation_hook(self, hook):
+        """
+        Call hook(scopes) after a route declared with invalidates= runs,
+        with the list of scopes it invalidated.
+        """
+        self.invalidation_hooks.append(hook)
+
+    def start_components(self):
+        for component in self.components.values():
+            component.start()
+
+    def requires(self, *names):
+        """
+        Decorator for JSON routes that can't run until the named
+        components are ready. Use it below @json_route.
+        """
+        def requires_decorator(func):
+            @functools.wraps(func)
+            def _requires_decorator(*args, **kwargs):
+                for name in names:
+                    if not self.components[name].ready:
+                        return {"error": f"{name} is not ready"}, 503
+                return func(*args, **kwargs)
+            return _requires_decorator
+        return requires_decorator
+
+    def ready_endpoint(self):
+        components = {name: component.status() for name, component in self.components.items()}
+        ready = all(component.ready for component in self.components.values())
+        response = jsonify({"ready": ready, "components": components})
+        response.status_code = 200 if ready else 503
+        return response
+
+    def enable_metrics(self, db=None, slow_request_threshold=None):
+        """
+        Start recording per-route timings, and per-request query counts and
+        times from db. Requests slower than slow_request_threshold seconds
+        are logged along with the queries they made.
+        """
+        self.metrics.enabled = True
+        self.slow_request_threshold = slow_request_threshold
+        if db is not None:
+            db.add_hook(self.record_query)
+            if db.replicas:
+                self.metrics.describe("db_healthy_replicas", "gauge",
+                    "Replicas currently taking reads.")
+                self.metrics.gauge("db_healthy_replicas",
+                    lambda: sum(replica.healthy for replica in db.replicas))
+
+    def record_query(self, sql, duration):
+        if has_request_context() and 'db_queries' in g:
+            g.db_queries.append((sql, duration))
+
+    def record_request(self, route, status_code, start, validated, handled, finished):
+        queries = g.get('db_queries', [])
+        db_time = sum(duration for _, duration in queries)
+        total = finished - start
+        # Record timings of the phases the request got to, a phase that
+        # was cut short ends when the request did
+        self.metrics.observe("request_seconds", total, route=route, phase="total")
+        self.metrics.observe("request_seconds", (validated or finished) - start,
+            route=route, phase="validation")
+        if validated is not None:
+            self.metrics.observe("request_seconds", (handled or finished) - validated,
+                route=route, phase="handler")
+        if handled is not None:
+            self.metrics.observe("request_seconds", finished - handled, route=route, phase="serialization")
+        self.metrics.observe("request_db_seconds", db_time, route=route)
+        self.metrics.observe("request_db_queries", len(queries), QUERY_COUNT_BUCKETS, route=route)
+        self.metrics.increment("responses_total", route=route, status=status_code)
+        # Log slow requests
+        if self.slow_request_threshold is not None and total >= self.slow_request_threshold:
+            print(f"Slow request: {route} took {total*1000:.1f}ms, "
+                f"{db_time*1000:.1f}ms in {len(queries)} queries")
+            for sql, duration in queries:
+                print(f"    {duration*1000:.1f}ms: {' '.join(sql.split())}")
+
+    def metrics_endpoint(self):
+        if not self.metrics.enabled:
+            abort(404)
+        return Response(self.metrics.render(), mimetype="text/plain; version=0.0.4")
 
     def json_route(self, *args, **kwargs):
         """
@@ -25,7 +217,36 @@ class JsonFlask(Flask):
         are replaced with '/'s
 
         If used as @json_route(...), the parameters are passed to Flask.route
-        unchanged.
+        unchanged, and the path defaults as above if none is given. Two
+        more keyword arguments control response caching:
+
+        cache: the name of the argument holding the id of the budget the
+        response depends on, or a function of the arguments dict returning
+        it or any other hashable scope. Successful responses are cached
+        until a route that invalidates that budget is called. They carry an
+        ETag, and a request whose If-None-Match header matches it gets an
+        empty 304 response.
+
+        shared: if true, cached responses don't depend on the user, so one
+        copy is shared by every user allowed to call the route.
+
+        authorize: a function of the arguments dict returning None if the
+        request may go ahead, otherwise an error and status code. It runs
+        before any cached or shared response is used, so permission checks
+        of shared routes belong here rather than in the route.
+
+        single_flight: if true, a request that arrives while an identical
+        one (same route and arguments, ignoring the user if shared) is
+        running waits for and shares its response instead of running again,
+        for up to single_flight.timeout seconds before running it itself.
+
+        invalidates: argument names (or a function of the arguments dict
+        returning budget ids) of the budgets the route changes. AllScopes
+        invalidates every cached response.
+
+        Responses larger than compression_threshold are compressed if the
+        client accepts it. The compressed copies of cached responses are
+        cached with them.
         """
         if len(args) == 1 and len(kwargs) == 0 and callable(args[0]):
             return self.json_route_raw_decorator(args[0])
@@ -37,10 +258,12 @@ class JsonFlask(Flask):
         json_decorator = json_endpoint(self)
         return route_decorator(json_decorator(func))
         
-    def json_route_called_decorator(self, *args, **kwargs):
-        route_decorator = self.route(*args, methods=['POST'], **kwargs)
-        json_decorator = json_endpoint(self)
+    def json_route_called_decorator(self, *args, cache=None, shared=False, invalidates=None,
+            authorize=None, single_flight=False, **kwargs):
+        json_decorator = json_endpoint(self, cache, shared, invalidates, authorize, single_flight)
         def json_route_decorator(func):
+            rule = args or ('/' + func.__name__.replace('_', '/'),)
+            route_decorator = self.route(*rule, methods=['POST'], **kwargs)
             return route_decorator(json_decorator(func))
         return json_route_decorator
 
@@ -48,16 +271,25 @@ class JsonFlask(Flask):
 class UserId:
     @staticmethod
     def validate_json(app, key):
-        user_id = app.authtoken_cache[request.json.get('authtoken', None)]
+        user_id = app.authenticate(request.json.get('authtoken', None))
         if user_id is None:
             response = jsonify({
                 "error": "login required"
             })
             response.status_code = 401
             abort(response)
+        g.user_id = user_id
         return user_id
 
 
+def current_user_id():
+    """
+    The id of the user making the current request, once UserId has
+    validated it, otherwise None.
+    """
+    return g.get('user_id', None) if has_request_context() else None
+
+
 class DateStr:
     @staticmethod
     def validate_json(app, key):
@@ -72,66 +304,212 @@ class DateStr:
             abort(response)
 
 
+class OptionalDateStr:
+    @staticmethod
+    def validate_json(app, key):
+        if request.json.get(key, None) is None:
+            return None
+        return DateStr.validate_json(app, key)
+
+
+def resolve_scopes(spec, arguments):
+    """
+    Turn a cache= or invalidates= spec into the list of scopes it names.
+    """
+    if spec is None:
+        return []
+    if callable(spec):
+        scopes = spec(arguments)
+        return list(scopes) if isinstance(scopes, (list, tuple, set)) else [scopes]
+    if isinstance(spec, str) or spec is AllScopes:
+        spec = [spec]
+    return [scope if scope is AllScopes else arguments[scope] for scope in spec]
+
+
 # JSON schema validator
-def json_endpoint(app: JsonFlask):
+def json_endpoint(app: JsonFlask, cache=None, shared=False, invalidates=None,
+        authorize=None, single_flight=False):
     def json_decorator(func):
         @functools.wraps(func)
         def _json_decorator():
-            # Make sure a JSON request came in
-            if not isinstance(request.json, dict):
-                response = jsonify({
-                    "error": "request was not valid JSON"
-                })
-                response.status_code = 400
-                abort(response)
-            # Make sure each field is present
-            parameters = inspect.signature(func, follow_wrapped=True).parameters
-            args = []
-            kwargs = {}
-            for parameter in parameters.values():
-                # If the type has a "validate_json" function, call that
-                if hasattr(parameter.annotation, 'validate_json'):
-                    arg_value = parameter.annotation.validate_json(app, parameter.name)
-                # Otherwise, if the type has an annotation, make sure it matches
-                elif parameter.annotation is not Parameter.empty:
-                    arg_value = request.json.get(parameter.name, None)
-                    # Get list of parameter options
-                    if get_origin(parameter.annotation) is Union:
-                        options = get_args(parameter.annotation)
-                    else:
-                        options = (parameter.annotation,)
-                    # Try each of the parameter options
-                    match = False
-                    for option in options:
-                        if arg_value == option or isinstance(arg_value, option):
-                            match = True
-                            break
-                    # If no match was found, return an error
-                    if not match:
+            # Only time the request if metrics are on
+            instrumented = app.metrics.enabled
+            if instrumented:
+                start = time.perf_counter()
+                g.db_queries = []
+            validated = handled = None
+            # Anything that isn't a response or an HTTP error is a server error
+            status = 500
+            try:
+                # Make sure the components every route needs are ready
+                for component in app.components.values():
+                    if component.required and not component.ready:
                         response = jsonify({
-                            "error": f'incorrect type for JSON parameter "{parameter.name}": "{type(arg_value).__name__}"'
+                            "error": f"{component.name} is not ready"
                         })
-                        response.status_code = 400
+                        response.status_code = 503
+                        abort(response)
+                # Make sure a JSON request came in
+                if not isinstance(request.json, dict):
+                    response = jsonify({
+                        "error": "request was not valid JSON"
+                    })
+                    response.status_code = 400
+                    abort(response)
+                # Make sure each field is present
+                parameters = inspect.signature(func, follow_wrapped=True).parameters
+                args = []
+                kwargs = {}
+                arguments = {}
+                for parameter in parameters.values():
+                    # If the type has a "validate_json" function, call that
+                    if hasattr(parameter.annotation, 'validate_json'):
+                        arg_value = parameter.annotation.validate_json(app, parameter.name)
+                    # Otherwise, if the type has an annotation, make sure it matches
+                    elif parameter.annotation is not Parameter.empty:
+                        arg_value = request.json.get(parameter.name, None)
+                        # Get list of parameter options
+                        if get_origin(parameter.annotation) is Union:
+                            options = get_args(parameter.annotation)
+                        else:
+                            options = (parameter.annotation,)
+                        # Try each of the parameter options
+                        match = False
+                        for option in options:
+                            if arg_value == option or isinstance(arg_value, option):
+                                match = True
+                                break
+                        # If no match was found, return an error
+                        if not match:
+                            response = jsonify({
+                                "error": f'incorrect type for JSON parameter "{parameter.name}": "{type(arg_value).__name__}"'
+                            })
+                            response.status_code = 400
+                            abort(response)
+                    # Finally, if no validate_json() and no annotation, don't validate this parameter
+                    else:
+                        arg_value = request.json.get(parameter.name, None)
+                    # Add argument to argument data structures
+                    arguments[parameter.name] = arg_value
+                    if parameter.kind in (Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD):
+                        args.append(arg_value)
+                    elif parameter.kind is Parameter.KEYWORD_ONLY:
+                        kwargs[parameter.name] = arg_value
+                if instrumented:
+                    validated = time.perf_counter()
+                # Check permissions before anything shared with other users is used
+                if authorize is not None:
+                    denied = authorize(arguments)
+                    if denied is not None:
+                        result, status_code = denied
+                        response = jsonify(result)
+                        response.status_code = status_code
                         abort(response)
-                # Finally, if no validate_json() and no annotation, don't validate this parameter
+                # Responses of shared routes don't depend on who asked
+                key_arguments = json.dumps({name: value for name, value in arguments.items()
+                    if not (shared and parameters[name].annotation is UserId)},
+                    sort_keys=True, default=str)
+                # Serve a cached response if nothing it depends on has changed.
+                # The generations are read before the handler runs, so a write
+                # that lands while it runs leaves the new entry unreachable.
+                cache_key = None
+                if cache is not None and app.response_cache.enabled:
+                    generations = [(scope, app.response_cache.generation(scope))
+                        for scope in resolve_scopes(cache, arguments)]
+                    cache_key = (request.url_rule.rule, key_arguments, tuple(generations))
+                    cached = app.response_cache.get(cache_key)
+                    if app.metrics.enabled:
+                        app.metrics.increment("response_cache_total", route=request.url_rule.rule,
+                            result="miss" if cached is None else "hit")
+                else:
+                    cached = None
+
+                def handle():
+                    nonlocal handled
+                    # Call the original function. A response that will be cached
+                    # must not come from a replica that hasn't caught up yet.
+                    with app.primary_reads() if cache_key is not None else contextlib.nullcontext():
+                        result = func(*args, **kwargs)
+                    if instrumented:
+                        handled = time.perf_counter()
+                    # If an integer is returned as the second value,
+                    # use that as the return code.
+                    if isinstance(result, (tuple, list)) and len(result) == 2:
+                        result, status_code = result
+                    else:
+                        status_code = 200
+                    # Invalidate whatever a successful call may have changed
+                    if 200 <= status_code < 300:
+                        scopes = [scope for scope in resolve_scopes(invalidates, arguments)
+                            if scope is not None]
+                        for scope in scopes:
+                            app.response_cache.bump(scope)
+                        if scopes:
+                            for hook in app.invalidation_hooks:
+                                hook(scopes)
+                    body = jsonify(result).get_data()
+                    etag = None
+                    entry = None
+                    if cache is not None and status_code == 200:
+                        etag = body_etag(body)
+                        if cache_key is not None:
+                            entry = app.response_cache.put(cache_key, status_code, body, etag)
+                    return status_code, body, etag, entry
+
+                handled = None
+                if cached is not None:
+                    status_code, body, etag, _ = cached
+                elif single_flight:
+                    # Identical requests already running share that one's response
+                    # Scopes are part of the key even with the cache off
+                    flight_key = cache_key or (request.url_rule.rule, key_arguments,
+                        tuple(resolve_scopes(cache, arguments)))
+                    (status_code, body, etag, cached), callers = app.single_flight.do(flight_key, handle)
+                    if app.metrics.enabled:
+                        app.metrics.increment("single_flight_total", route=request.url_rule.rule,
+                            role="follower" if callers is None else "leader")
+                        if callers is not None:
+                            app.metrics.observe("single_flight_callers", callers,
+                                SINGLE_FLIGHT_BUCKETS, route=request.url_rule.rule)
+                else:
+                    status_code, body, etag, cached = handle()
+                if instrumented and handled is None:
+                    handled = time.perf_counter()
+                response = app.response_class(body, status=status_code, mimetype="application/json")
+                # Pick a content coding if the body is big enough to bother
+                encoding = None
+                if app.compression_threshold is not None:
+                    response.vary.add("Accept-Encoding")
+                    if response.content_length >= app.compression_threshold:
+                        encoding = negotiate_encoding(request.accept_encodings)
+                # Each coding is a different representation, so gets its own tag
+                if etag is not None and encoding is not None:
+                    etag = f"{etag}-{encoding}"
+                # Tell the client if the copy it already has is still current
+                if etag is not None and request.if_none_match.contains(etag):
+                    response = app.response_class(status=304)
+                    response.set_etag(etag)
+                    response.vary.add("Accept-Encoding")
                 else:
-                    arg_value = request.json.get(parameter.name, None)
-                # Add argument to argument data structures
-                if parameter.kind in (Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD):
-                    args.append(arg_value)
-                elif parameter.kind is Parameter.KEYWORD_ONLY:
-                    kwargs[parameter.name] = arg_value
-            # Call the original function
-            result = func(*args, **kwargs)
-            # If an integer is returned as the second value,
-            # use that as the return code.
-            if isinstance(result, (tuple, list)) and len(result) == 2:
-                result, status_code = result
-                response = jsonify(result)
-                response.status_code = status_code
-            else:
-                response = jsonify(result)
-            # Return the modified response
-            return response
+                    if etag is not None:
+                        response.set_etag(etag)
+                    if encoding is not None:
+                        if cached is not None:
+                            data = app.response_cache.encoded(cache_key, cached, encoding, compress)
+                        else:
+                            data = compress(response.get_data(), encoding)
+                        response.set_data(data)
+                        response.headers["Content-Encoding"] = encoding
+                # Return the modified response
+                status = response.status_code
+                return response
+            except HTTPException as e:
+                status = e.code if e.response is None else e.response.status_code
+                raise
+            finally:
+                # Requests cut short by abort() or an error count too
+                if instrumented:
+                    app.record_request(request.url_rule.rule, status,
+                        start, validated, handled, time.perf_counter())
         return _json_decorator
     return json_decorator
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for the API's database, configured through the same
+ISOMETRIC_* environment variables as the API itself.
+
+    reconcile   Rebuild the summary tables (running totals) from the
+                expenses table, in case they have drifted.
+    partition   Create upcoming partitions of the partitioned tables, moving
+                rows out of their default partitions. Existing tables that
+                aren't partitioned yet are converted first. Run it
+                periodically, e.g. from cron.
+    archive     Detach the partitions that only hold rows from before
+                --before, leaving them as standalone tables to dump and
+                drop. The summary tables keep counting the archived rows,
+                which a later reconcile would drop from them.
+"""
+
+import time
+from argparse import ArgumentParser
+from datetime import date
+
+from api import db
+
+
+def reconcile(args):
+    # Make sure the tables and triggers exist before rebuilding
+    db.validate_schema()
+    start = time.perf_counter()
+    db.rebuild(args.tables)
+    print(f"Rebuilt summary tables in {time.perf_counter() - start:.2f}s")
+
+
+def partition(args):
+    tables = args.tables or db.partitioned_tables()
+    for table in tables:
+        if db.is_partitioned(table) is False:
+            start = time.perf_counter()
+            db.partition_table(table)
+            print(f"Partitioned {table} in {time.perf_counter() - start:.2f}s")
+    # Creates the upcoming partitions of every partitioned table
+    db.validate_schema()
+
+
+def archive(args):
+    if args.before is None:
+        raise SystemExit("archive needs --before")
+    for table in args.tables or db.partitioned_tables():
+        for name in db.detach_partitions(table, args.before):
+            print(f"Detached {name} from {table}")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("command", choices=['reconcile', 'partition', 'archive'])
+    parser.add_argument("-t", "--tables", nargs='+', default=None,
+            help="Only rebuild, partition or archive these tables.")
+    parser.add_argument("-b", "--before", type=date.fromisoformat, default=None,
+            help="Archive partitions that end on or before this date (YYYY-MM-DD).")
+    args = parser.parse_args()
+
+    if args.command == 'reconcile':
+        reconcile(args)
+    elif args.command == 'partition':
+        partition(args)
+    elif args.command == 'archive':
+        archive(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import threading
+
+
+# Histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """
+    In-process metrics registry that renders in the Prometheus text format.
+    Nothing is recorded unless enabled is set, so callers can check it once
+    and skip their timing work entirely.
+    """
+    def __init__(self, enabled=False, prefix="isometric"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.help = {}
+        self.types = {}
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, help_text):
+        self.types[name] = kind
+        self.help[name] = help_text
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, func, **labels):
+        """
+        Register a function that is called for the gauge's current value
+        each time the metrics are rendered.
+        """
+        self.gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def render(self):
+        lines = []
+        described = set()
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {self.prefix}_{name} {self.help[name]}")
+                lines.append(f"# TYPE {self.prefix}_{name} {self.types.get(name, kind)}")
+
+        with self.lock:
+            histograms = sorted((key, (list(h.counts), h.count, h.sum, h.buckets)) for key, h in self.histograms.items())
+            counters = sorted(self.counters.items())
+        gauges = sorted(self.gauges.items(), key=lambda item: item[0])
+
+        for (name, labels), (counts, count, total, buckets) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.prefix}_{name}_bucket{format_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{self.prefix}_{name}_bucket{format_labels(labels, le='+Inf')} {count}")
+            lines.append(f"{self.prefix}_{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{self.prefix}_{name}_count{format_labels(labels)} {count}")
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{self.prefix}_{name}{format_labels(labels)} {value}")
+        for (name, labels), func in gauges:
+            header(name, "gauge")
+            lines.append(f"{self.prefix}_{name}{format_labels(labels)} {func()}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
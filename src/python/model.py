@@ -1,52 +1,88 @@
 #!/usr/bin/env python3
 
+import csv
+import itertools
 import json
+import multiprocessing
 import numpy
-import pandas
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import time
 from argparse import ArgumentParser
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.metrics import mean_squared_error
+
+import dataprep
+
+
+SNAPSHOTS_PATH = "data/snapshots.json"
+
+# Pads the front of short sequences in a batch. Scaled inputs never get
+# anywhere near this, so it can't be confused with real data.
+MASK_VALUE = -1e9
 
 
 class StockModel:
-    def __init__(self, neurons=1):
+    def __init__(self, neurons=1, learning_rate=0.001):
         # Import ML libraries here rather than at the top because
         # a lot of code is run at import time. Importlib will ensure
         # these imports only run once.
         from keras.models import Sequential
         from keras.layers import LSTM, Dense
+        from keras.optimizers import Adam
 
         # Build model
         self.model = Sequential()
         self.model.add(LSTM(neurons, batch_input_shape=[1, 1, 1], stateful=True))
         self.model.add(Dense(1))
-        self.model.compile(loss='mean_squared_error', optimizer='adam')
+        self.model.compile(loss='mean_squared_error', optimizer=Adam(learning_rate=learning_rate))
 
         # Create scaler fit to the training input
         self.scaler = PreservedScaler()
 
+        # Stateless copy of the model used for batched predictions,
+        # built on first use.
+        self._batch_model = None
+
     def save(self, path):
         self.model.save(path)
+        # Keep the training scaler next to the weights
+        if self.scaler.fitted:
+            self.scaler.save(scaler_path(path))
 
     @classmethod
     def load(cls, path):
         from tensorflow import keras
         obj = cls()
         obj.model = keras.models.load_model(path)
+        # Models saved before scalers were stored fall back to fitting
+        # a scaler to each input sequence
+        if os.path.exists(scaler_path(path)):
+            obj.scaler = PreservedScaler.load(scaler_path(path))
         return obj
 
+    def scaler_for(self, differences):
+        """
+        Returns the scaler fitted during training, or if there isn't one,
+        a new scaler fitted to the given differences.
+        """
+        if self.scaler.fitted:
+            return self.scaler
+        return PreservedScaler(differences)
+
     def train(self, training_input, training_output, epochs=50):
         if len(training_input.shape) == 2:
             # Fit scaler before training model
-            self.scaler.fit(training_input[0])
+            self.scaler.fit(training_input)
             # For each sample, go over the whole epoch of training
             for i, input_sample in enumerate(training_input):
+                input_sample = self.scaler.shrink(shape_3d(input_sample))
+                output_sample = self.scaler.shrink(shape_1d(training_output[i]))
                 for _ in range(epochs):
-                    output_sample = training_output[i]
-                    input_sample = self.scaler.shrink(shape_3d(input_sample))
-                    output_sample = self.scaler.shrink(shape_1d(output_sample))
                     self.model.fit(input_sample, output_sample, epochs=1, batch_size=1,
                             verbose=0, shuffle=False)
                     self.model.reset_states()
@@ -66,77 +102,186 @@ class StockModel:
 
     def predict_verbose(self, input_sequence):
         # Convert the inputs to differences
-        differences = []
-        for i in range(1, len(input_sequence)):
-            differences.append(input_sequence[i] - input_sequence[i - 1])
+        differences = dataprep.differences(input_sequence)
 
         # Scale the inputs down
-        self.scaler.fit(differences)
-        scaled_values = self.scaler.shrink(differences)
+        scaler = self.scaler_for(differences)
+        scaled_values = scaler.shrink(differences, inplace=True)
 
-        # Make predictions
+        # Make predictions, reusing one input buffer for every step
         expectations = scaled_values[1:]
-        predictions = []
-        for input_value in scaled_values[:-1]:
-            scaled_output = self.model.predict(shape_3d(input_value), batch_size=1)
-            predictions.append(shape_0d(scaled_output))
+        predictions = numpy.empty(len(expectations), dtype=numpy.float32)
+        step = numpy.empty((1, 1, 1), dtype=numpy.float32)
+        for i, input_value in enumerate(scaled_values[:-1]):
+            step[0, 0, 0] = input_value
+            predictions[i] = shape_0d(self.model.predict(step, batch_size=1))
 
         # Scale the inputs and outputs up
-        expectations = self.scaler.regrow(expectations)
-        predictions = self.scaler.regrow(predictions)
+        expectations = scaler.regrow(expectations, inplace=True)
+        predictions = scaler.regrow(predictions, inplace=True)
 
         # Return the expected values and predictions made
         return predictions, expectations
 
     def predict(self, input_sequence):
         # Convert the inputs to differences
-        differences = []
-        for i in range(1, len(input_sequence)):
-            differences.append(input_sequence[i] - input_sequence[i - 1])
+        input_sequence = standardize_array(input_sequence)
+        differences = dataprep.differences(input_sequence)
 
         # Scale the inputs down
-        self.scaler.fit(differences)
-        scaled_values = self.scaler.shrink(differences)
+        scaler = self.scaler_for(differences)
+        scaled_values = scaler.shrink(differences, inplace=True)
 
-        # Make predictions
+        # Make predictions, reusing one input buffer for every step
+        step = numpy.empty((1, 1, 1), dtype=numpy.float32)
         for input_value in scaled_values:
-            scaled_output = self.model.predict(shape_3d(input_value), batch_size=1)
+            step[0, 0, 0] = input_value
+            scaled_output = self.model.predict(step, batch_size=1)
 
         # Return the rescaled output
-        return input_sequence[-1] + shape_0d(self.scaler.regrow(scaled_output))
+        return float(input_sequence[-1] + shape_0d(scaler.regrow(scaled_output)))
+
+    def batch_model(self):
+        """
+        Returns a stateless copy of the model that accepts a batch of
+        variable length sequences. Each sequence starts from a fresh LSTM
+        state, so predictions in the same batch can't affect each other.
+        """
+        if self._batch_model is None:
+            from keras.models import Sequential
+            from keras.layers import LSTM, Dense, Masking
+
+            lstm = self.model.layers[0]
+            batch_model = Sequential()
+            batch_model.add(Masking(mask_value=MASK_VALUE, input_shape=(None, 1)))
+            batch_model.add(LSTM(lstm.units))
+            batch_model.add(Dense(1))
+            batch_model.set_weights(self.model.get_weights())
+            self._batch_model = batch_model
+        return self._batch_model
+
+    def predict_batch(self, input_sequences):
+        """
+        Same as predict(), but for many sequences at once in a single pass
+        through the stateless batch model.
+        """
+        # Convert each input to differences and scale them down
+        input_sequences = [standardize_array(input_sequence) for input_sequence in input_sequences]
+        scalers = []
+        rows = []
+        for input_sequence in input_sequences:
+            differences = dataprep.differences(input_sequence)
+            scaler = self.scaler_for(differences)
+            rows.append(scaler.shrink(differences, inplace=True))
+            scalers.append(scaler)
+
+        # Pad the front of the shorter sequences so every sequence ends
+        # on the last timestep
+        length = max(len(row) for row in rows)
+        batch = numpy.full((len(rows), length, 1), MASK_VALUE, dtype=numpy.float32)
+        for i, row in enumerate(rows):
+            batch[i, length - len(row):, 0] = row
+
+        # Make predictions
+        scaled_outputs = self.batch_model()(batch, training=False).numpy()
+
+        # Return the rescaled outputs
+        return [
+            float(input_sequence[-1] + shape_0d(scaler.regrow(scaled_output)))
+            for input_sequence, scaler, scaled_output
+            in zip(input_sequences, scalers, scaled_outputs)
+        ]
 
 
 class PreservedScaler:
+    """
+    Min-max scaler that maps values into feature_range, and back again.
+    Only the min and max of the fitted data are kept, so a scaler fitted
+    during training can be saved with the model and reused for inference.
+    """
     def __init__(self, arr=None, *, feature_range=(0,1)):
-        self.scaler = MinMaxScaler(feature_range=feature_range)
+        self.feature_range = feature_range
+        self.data_min = None
+        self.data_max = None
+        self.scale = None
+        self.offset = None
         if arr is not None:
             self.fit(arr)
 
+    @property
+    def fitted(self):
+        return self.scale is not None
+
     def fit(self, arr):
-        self.scaler.fit(shape_2d(arr))
+        arr = standardize_array(arr)
+        self.set_range(float(arr.min()), float(arr.max()))
+
+    def set_range(self, data_min, data_max):
+        self.data_min = data_min
+        self.data_max = data_max
+        # Constant data has no range to scale by, so it is only shifted
+        data_range = (data_max - data_min) or 1.0
+        low, high = self.feature_range
+        self.scale = (high - low) / data_range
+        self.offset = low - data_min * self.scale
+
+    def shrink(self, arr, inplace=False):
+        """
+        Returns arr scaled into the feature range. With inplace=True, a
+        float32 array given as arr is overwritten rather than copied.
+        """
+        arr = standardize_array(arr) if inplace else numpy.array(arr, dtype=numpy.float32, ndmin=1)
+        arr *= self.scale
+        arr += self.offset
+        return arr
+
+    def regrow(self, arr, inplace=False):
+        """
+        Returns arr scaled from the feature range back to the data range.
+        With inplace=True, a float32 array given as arr is overwritten
+        rather than copied.
+        """
+        arr = standardize_array(arr) if inplace else numpy.array(arr, dtype=numpy.float32, ndmin=1)
+        arr -= self.offset
+        arr /= self.scale
+        return arr
 
-    def shrink(self, arr):
-        shaper = get_shaper(arr)
-        return shaper(self.scaler.transform(shape_2d(arr)))
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({
+                "feature_range": list(self.feature_range),
+                "data_min": self.data_min,
+                "data_max": self.data_max,
+            }, f)
 
-    def regrow(self, arr):
-        shaper = get_shaper(arr)
-        return shaper(self.scaler.inverse_transform(shape_2d(arr)))
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        obj = cls(feature_range=tuple(data["feature_range"]))
+        obj.set_range(data["data_min"], data["data_max"])
+        return obj
 
 
-def get_shaper(arr):
-    return partial(shape_nd, n=len(standardize_array(arr).shape))
+def scaler_path(model_path):
+    model_path = Path(model_path)
+    # Keras saves models as directories, unless saving to a single file
+    if model_path.suffix in (".h5", ".keras"):
+        return model_path.with_name(model_path.name + ".scaler.json")
+    return model_path / "scaler.json"
 
 
 def standardize_array(arr):
-    if isinstance(arr, pandas.DataFrame):
-        return arr.values
-    elif isinstance(arr, numpy.ndarray):
-        return arr
-    elif isinstance(arr, (list, set, dict)):
-        return pandas.DataFrame(arr).values
-    else:
-        return pandas.DataFrame([arr]).values
+    """
+    Returns arr as a contiguous float32 array with at least one dimension.
+    Arrays that are already in that form are returned as is, not copied.
+    """
+    if not (isinstance(arr, numpy.ndarray) and arr.dtype == numpy.float32
+            and arr.flags.c_contiguous):
+        arr = numpy.ascontiguousarray(arr, dtype=numpy.float32)
+    if arr.ndim == 0:
+        arr = arr.reshape((1,))
+    return arr
 
 
 def shape_3d(arr):
@@ -181,34 +326,52 @@ def display_directions(arr):
     print()
 
 
-def perform_test(args):
-    # Load data from file
-    with open("data/snapshots.json") as f:
-        snapshots = json.load(f)
-
-    # Take the difference at each timestep
-    data = []
-    for values in snapshots.values():
-        datum = []
-        prev = None
-        for value in values:
-            if prev is not None:
-                datum.append(value - prev)
-            prev = value
-        data.append(datum)
+def prepare_test_data(window=None):
+    """
+    Returns (training_input, training_output, testing_input) built from the
+    snapshots file. If window is given, the training sequences are cut into
+    consecutive windows of that many inputs, each trained on separately.
+    """
+    # Load the differences at each timestep
+    data = dataprep.load_differences(SNAPSHOTS_PATH)
 
     # Split values into training and testing values
-    training_cutoff = int(0.8 * len(values))
-    training_data = [datum[:training_cutoff] for datum in data]
-    testing_data = [datum[training_cutoff:] for datum in data]
+    training_data, testing_data = dataprep.train_test_split(data)
+
+    # Cut the training history into windows
+    if window:
+        training_data = dataprep.sliding_windows(training_data, window + 1, stride=window)
 
     # Split training values into input and output
-    training_input = pandas.DataFrame(datum[:-1] for datum in training_data).values
-    training_output = pandas.DataFrame(datum[1:] for datum in training_data).values
+    training_input, training_output = dataprep.split_input_output(training_data)
 
-    # Split testing values into input and output
-    testing_input = pandas.DataFrame(datum[:-1] for datum in testing_data).values
-    testing_output = pandas.DataFrame(datum[1:] for datum in testing_data).values
+    # Split testing values into input (the output is derived by predict_verbose)
+    testing_input, _ = dataprep.split_input_output(testing_data)
+
+    return training_input, training_output, testing_input
+
+
+def evaluate(model, testing_input):
+    """
+    Returns the RMSE of the model's predictions over the testing input,
+    and the mean latency of a single prediction in seconds.
+    """
+    # Gather predictions and expectations for each sample
+    predictions = []
+    expectations = []
+    start = time.perf_counter()
+    for input_sample in testing_input:
+        sub_predictions, sub_expectations = model.predict_verbose(input_sample)
+        predictions.extend(sub_predictions)
+        expectations.extend(sub_expectations)
+    latency = (time.perf_counter() - start) / max(len(predictions), 1)
+
+    errors = numpy.subtract(expectations, predictions, dtype=numpy.float64)
+    return float(numpy.sqrt(numpy.mean(errors * errors))), latency
+
+
+def perform_test(args):
+    training_input, training_output, testing_input = prepare_test_data()
 
     print("----------------")
     print("Compiling model.")
@@ -226,36 +389,228 @@ def perform_test(args):
     print("Making predictions.")
     print("-------------------")
 
-    # Gather predictions and expectations for each sample
-    predictions = []
-    expectations = []
-    for input_sample in testing_input:
-        sub_predictions, sub_expectations = model.predict_verbose(input_sample)
-        predictions.extend(sub_predictions)
-        expectations.extend(sub_expectations)
-
-    print("RMSE: ", mean_squared_error(expectations, predictions) ** 0.5)
+    rmse, _ = evaluate(model, testing_input)
+    print("RMSE: ", rmse)
+
+
+def init_sweep_worker(threads):
+    # Thread pools are sized when TensorFlow is first imported, so the
+    # limits have to be in place before anything imports it.
+    for variable in ("OMP_NUM_THREADS", "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"):
+        os.environ[variable] = str(threads)
+    os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+    import tensorflow
+    tensorflow.config.threading.set_intra_op_parallelism_threads(threads)
+    tensorflow.config.threading.set_inter_op_parallelism_threads(threads)
+
+
+def run_trial(trial, neurons, epochs, learning_rate, window, sweep_dir):
+    training_input, training_output, testing_input = prepare_test_data(window)
+
+    # Train
+    model = StockModel(neurons=neurons, learning_rate=learning_rate)
+    start = time.perf_counter()
+    model.train(training_input, training_output, epochs=epochs)
+    train_time = time.perf_counter() - start
+
+    # Evaluate
+    rmse, latency = evaluate(model, testing_input)
+
+    # Keep the artifact in case this trial wins
+    artifact = Path(sweep_dir) / f"trial_{trial}"
+    model.save(str(artifact))
+
+    return {
+        "trial": trial,
+        "neurons": neurons,
+        "epochs": epochs,
+        "learning_rate": learning_rate,
+        "window": window,
+        "rmse": rmse,
+        "train_time": train_time,
+        "inference_latency": latency,
+        "artifact": str(artifact),
+    }
+
+
+def perform_sweep(args):
+    grid = list(itertools.product(
+        args.sweep_neurons, args.sweep_epochs,
+        args.sweep_learning_rates, args.sweep_windows
+    ))
+    Path(args.sweep_dir).mkdir(parents=True, exist_ok=True)
+
+    print("-----------------------------------")
+    print(f"Running {len(grid)} trials on {args.workers} workers.")
+    print("-----------------------------------")
+
+    # Spawn rather than fork so each worker starts TensorFlow from scratch
+    # with its own thread limits.
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context,
+            initializer=init_sweep_worker, initargs=(args.threads_per_worker,)) as pool:
+        futures = [
+            pool.submit(run_trial, trial, *params, args.sweep_dir)
+            for trial, params in enumerate(grid)
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            print(result)
+            results.append(result)
+
+    # Write leaderboard, best first
+    results.sort(key=lambda result: result["rmse"])
+    leaderboard = Path(args.leaderboard)
+    with open(leaderboard.with_suffix(".json"), "w") as f:
+        json.dump(results, f, indent=4)
+    with open(leaderboard.with_suffix(".csv"), "w", newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+
+    # Publish the best model
+    best = results[0]
+    print("Best trial:", best)
+    if args.versioned:
+        publish_artifact(best["artifact"], next_version_path(args.save_path))
+    else:
+        publish_artifact(best["artifact"], Path(args.save_path))
+
+
+def time_calls(func, repeat):
+    """
+    Returns the sorted latencies, in seconds, of calling func repeat times.
+    """
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    return sorted(latencies)
+
+
+def latency_stats(latencies):
+    return {
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] * 1000,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+    }
+
+
+def random_walk(length, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return (100 + numpy.cumsum(rng.normal(0, 1, length))).tolist()
+
+
+def measure_import_time():
+    """
+    Time importing this module and TensorFlow in a fresh interpreter, so
+    nothing already imported by this process skews the result.
+    """
+    code = (
+        "import time; start = time.perf_counter(); "
+        "import model; from tensorflow import keras; "
+        "print(time.perf_counter() - start)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=Path(__file__).parent,
+        capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def perform_bench(args):
+    results = {}
+
+    print("-----------------")
+    print("Timing imports.")
+    print("-----------------")
+    results["import_seconds"] = measure_import_time()
+
+    print("-----------------")
+    print("Loading model.")
+    print("-----------------")
+    start = time.perf_counter()
+    model = StockModel.load(args.save_path)
+    results["load_seconds"] = time.perf_counter() - start
+
+    # The first call of each path pays for graph tracing, keep it separate
+    sequence = random_walk(args.bench_lengths[0])
+    start = time.perf_counter()
+    model.predict(sequence)
+    model.predict_batch([sequence])
+    results["first_prediction_seconds"] = time.perf_counter() - start
+
+    # Each engine predicts the value following a single sequence
+    engines = {
+        "keras": lambda sequence: model.predict(sequence),
+        "keras_verbose": lambda sequence: model.predict_verbose(sequence),
+        "batch": lambda sequence: model.predict_batch([sequence]),
+    }
+
+    print("-----------------")
+    print("Timing predictions.")
+    print("-----------------")
+    profiler = start_profiler(args.profile)
+    results["scaling"] = {}
+    for name, engine in engines.items():
+        results["scaling"][name] = {}
+        for length in args.bench_lengths:
+            sequence = random_walk(length)
+            stats = latency_stats(time_calls(lambda: engine(sequence), args.bench_repeat))
+            results["scaling"][name][length] = stats
+            print(f"{name:<16}length {length:>5}: p50 {stats['p50_ms']:8.2f}ms  "
+                f"p95 {stats['p95_ms']:8.2f}ms  mean {stats['mean_ms']:8.2f}ms")
+    stop_profiler(args.profile, profiler, args.profile_output)
+
+    # ru_maxrss is in kilobytes on Linux
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f"Import: {results['import_seconds']:.2f}s  Load: {results['load_seconds']:.2f}s  "
+        f"First prediction: {results['first_prediction_seconds']:.2f}s  "
+        f"Peak RSS: {results['peak_rss_mb']:.0f}MB")
+    if args.bench_output:
+        with open(args.bench_output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+def start_profiler(kind):
+    if kind == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    elif kind == 'pyinstrument':
+        # Optional dependency, only needed when asked for
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+    return None
+
+
+def stop_profiler(kind, profiler, output):
+    if kind == 'cprofile':
+        import pstats
+        profiler.disable()
+        if output:
+            profiler.dump_stats(output)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    elif kind == 'pyinstrument':
+        profiler.stop()
+        if output:
+            with open(output, "w") as f:
+                f.write(profiler.output_html())
+        print(profiler.output_text(unicode=True))
 
 
 def create_model(args):
-    # Load data from file
-    with open("data/snapshots.json") as f:
-        snapshots = json.load(f)
-
-    # Take the difference at each timestep
-    data = []
-    for values in snapshots.values():
-        datum = []
-        prev = None
-        for value in values:
-            if prev is not None:
-                datum.append(value - prev)
-            prev = value
-        data.append(datum)
+    # Load the differences at each timestep
+    data = dataprep.load_differences(SNAPSHOTS_PATH)
 
     # Split training values into input and output
-    training_input = pandas.DataFrame(datum[:-1] for datum in data).values
-    training_output = pandas.DataFrame(datum[1:] for datum in data).values
+    training_input, training_output = dataprep.split_input_output(data)
 
     print("----------------")
     print("Compiling model.")
@@ -270,21 +625,93 @@ def create_model(args):
     model.train(training_input, training_output, epochs=args.epochs)
 
     # Save model to disk for later
-    model.save(args.save_path)
+    if args.versioned:
+        save_versioned(model, args.save_path)
+    else:
+        model.save(args.save_path)
+
+
+def next_version_path(save_path):
+    """
+    Returns <save_path>.<N>, where N is one more than the newest version
+    already saved.
+    """
+    save_path = Path(save_path)
+    pattern = re.compile(rf"^{re.escape(save_path.name)}(?:\.(\d+))?$")
+    versions = [-1]
+    if save_path.parent.exists():
+        for path in save_path.parent.iterdir():
+            match = pattern.match(path.name)
+            if match is not None:
+                versions.append(int(match.group(1) or 0))
+    return save_path.with_name(f"{save_path.name}.{max(versions) + 1}")
+
+
+def save_versioned(model, save_path):
+    """
+    Save the model as the next version of save_path. The model is written
+    to a temporary path first and renamed into place, so a watching API
+    never sees a partial model.
+    """
+    version_path = next_version_path(save_path)
+    tmp_path = version_path.with_name(version_path.name + ".tmp")
+    model.save(str(tmp_path))
+    os.rename(tmp_path, version_path)
+    print(f"Saved model to {version_path}")
+
+
+def publish_artifact(artifact, path):
+    """
+    Copy a saved model to path, replacing anything already there.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.copytree(artifact, tmp_path)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    print(f"Saved model to {path}")
 
 
 def main():
     parser = ArgumentParser()
     parser.add_argument("-n", "--neurons", type=int, default=1)
     parser.add_argument("-e", "--epochs", type=int, default=50)
-    parser.add_argument("-m", "--mode", choices=['test', 'create_model'], default='test')
+    parser.add_argument("-m", "--mode", choices=['test', 'create_model', 'sweep', 'bench'], default='test')
     parser.add_argument("-p", "--save-path", default='./appdata/model/stock_lstm')
+    parser.add_argument("-V", "--versioned", action="store_true",
+            help="Save the model as the next numbered version of --save-path.")
+    # Sweep mode options
+    parser.add_argument("--sweep-neurons", type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument("--sweep-epochs", type=int, nargs='+', default=[10, 50])
+    parser.add_argument("--sweep-learning-rates", type=float, nargs='+', default=[0.001, 0.01])
+    parser.add_argument("--sweep-windows", type=int, nargs='+', default=[0],
+            help="Training window lengths to try, 0 trains on the whole history.")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("-t", "--threads-per-worker", type=int, default=1)
+    parser.add_argument("--sweep-dir", default='./appdata/sweep',
+            help="Where each trial's model is saved.")
+    parser.add_argument("-l", "--leaderboard", default='./appdata/sweep/leaderboard',
+            help="Leaderboard path, written as both .csv and .json.")
+    # Bench mode options
+    parser.add_argument("--bench-lengths", type=int, nargs='+', default=[8, 32, 128, 512],
+            help="Sequence lengths to time predictions for.")
+    parser.add_argument("--bench-repeat", type=int, default=20,
+            help="Predictions timed per engine and sequence length.")
+    parser.add_argument("--bench-output", default=None, help="Write bench results to this JSON file.")
+    parser.add_argument("--profile", choices=['cprofile', 'pyinstrument'], default=None,
+            help="Profile the timed predictions.")
+    parser.add_argument("--profile-output", default=None,
+            help="Where to save the profile (.prof for cprofile, .html for pyinstrument).")
     args = parser.parse_args()
 
     if args.mode == 'test':
         perform_test(args)
     elif args.mode == 'create_model':
         create_model(args)
+    elif args.mode == 'sweep':
+        perform_sweep(args)
+    elif args.mode == 'bench':
+        perform_bench(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+import re
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from model import StockModel
+
+
+class ModelRegistry:
+    """
+    Tracks the versioned model artifacts in a directory and serves the
+    newest one. Artifacts are named <name> (version 0) or <name>.<version>.
+    New versions are loaded and warmed up in a background thread, then
+    swapped in with a single assignment so in-flight predictions keep
+    using the model they started with.
+    """
+    def __init__(self, directory, name):
+        self.directory = Path(directory)
+        self.name = name
+        self.pattern = re.compile(rf"^{re.escape(name)}(?:\.(\d+))?$")
+        self.model = None
+        self.version = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def available_versions(self):
+        versions = {}
+        for path in self.directory.iterdir():
+            match = self.pattern.match(path.name)
+            if match is not None:
+                versions[int(match.group(1) or 0)] = path
+        return versions
+
+    def load(self, version, path):
+        with self.lock:
+            # Another thread may have loaded this version while we waited
+            if self.version is not None and version <= self.version:
+                return False
+            print(f"Loading model version {version} from {path}")
+            model = StockModel.load(str(path))
+            warm_up(model)
+            # Swap the new model in
+            self.model = model
+            self.version = version
+            self.loaded_at = datetime.now()
+        print(f"Model version {version} is active")
+        return True
+
+    def load_latest(self):
+        versions = self.available_versions()
+        if not versions:
+            raise FileNotFoundError(f"no {self.name} models found in {self.directory}")
+        version = max(versions)
+        return self.load(version, versions[version])
+
+    def watch(self, interval=30):
+        """
+        Start a daemon thread that loads new model versions as they appear.
+        """
+        def _watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.load_latest()
+                except Exception as e:
+                    print(f"Failed to load new model: {e}")
+        thread = threading.Thread(target=_watch, name="model-watcher", daemon=True)
+        thread.start()
+        return thread
+
+
+def warm_up(model):
+    # Run throwaway predictions so graph tracing happens before the
+    # model takes real requests, then clear the LSTM state they left behind.
+    model.predict([1.0, 2.0, 1.5, 3.0])
+    model.model.reset_states()
+    model.predict_batch([[1.0, 2.0, 1.5, 3.0], [2.0, 1.0]])
@@ -0,0 +1,122 @@
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+
+
+# Payload for a change that may affect every budget
+ALL_BUDGETS = "*"
+
+
+class BudgetNotifier:
+    """
+    Publishes the ids of changed budgets on a Postgres notification
+    channel, and fans the changes published by every API process out to
+    local subscribers over a single listening connection. Subscribers get
+    a queue that receives the id of each of their budgets that changes,
+    or ALL_BUDGETS when changes may have been missed.
+    """
+    def __init__(self, dsn, channel="budget_changes", retry_interval=5):
+        self.dsn = dsn
+        self.channel = channel
+        self.retry_interval = retry_interval
+        # Tells this process's notifications apart from other processes'
+        self.origin = os.urandom(8).hex()
+        self.subscribers = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.connected = False
+        self.thread = None
+
+    @property
+    def subscriber_count(self):
+        return len(self.subscribers)
+
+    def subscribe(self, budget_ids, limit=None):
+        """
+        A queue receiving changes to budget_ids, or None if there are
+        already limit subscribers.
+        """
+        subscription = queue.Queue()
+        with self.lock:
+            if limit is not None and len(self.subscribers) >= limit:
+                return None
+            self.subscribers[subscription] = set(budget_ids)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.pop(subscription, None)
+
+    def add_listener(self, listener):
+        """
+        Call listener(budget_id) for each change published by another
+        process, with ALL_BUDGETS when changes may have been missed.
+        """
+        self.listeners.append(listener)
+
+    def publish(self, db, budget_ids):
+        payloads = [f"{self.origin} {budget_id}" for budget_id in budget_ids]
+        if not payloads:
+            return
+        try:
+            db.execute("""
+                SELECT pg_notify(%s, payload)
+                FROM unnest(%s::text[]) AS payload;
+            """, (self.channel, payloads))
+        except psycopg2.Error as e:
+            # Subscribers will see the change the next time they load it
+            print(f"Failed to publish budget changes {budget_ids}: {e}")
+
+    def deliver(self, budget_id, origin=None):
+        if origin != self.origin:
+            for listener in self.listeners:
+                listener(budget_id)
+        with self.lock:
+            subscriptions = [subscription
+                for subscription, budget_ids in self.subscribers.items()
+                if budget_id == ALL_BUDGETS or budget_id in budget_ids]
+        for subscription in subscriptions:
+            subscription.put(budget_id)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="budget-notifier", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except (psycopg2.Error, OSError) as e:
+                print(f"Lost budget notification connection, retrying in {self.retry_interval}s: {e}")
+            self.connected = False
+            time.sleep(self.retry_interval)
+
+    def listen(self):
+        connection = psycopg2.connect(self.dsn)
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.channel};")
+            self.connected = True
+            # Anything published while we weren't listening was missed
+            self.deliver(ALL_BUDGETS)
+            while True:
+                # Wake up now and then so a dead connection is noticed
+                if select.select([connection], [], [], 30) == ([], [], []):
+                    with connection.cursor() as cursor:
+                        cursor.execute("SELECT 1;")
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    origin, _, budget_id = notify.payload.partition(" ")
+                    if budget_id != ALL_BUDGETS:
+                        budget_id = int(budget_id)
+                    self.deliver(budget_id, origin)
+        finally:
+            connection.close()
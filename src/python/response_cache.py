@@ -0,0 +1,99 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# Scope to invalidate when a write could affect any cached response
+AllScopes = object()
+
+
+def body_etag(body):
+    """
+    Strong entity tag for an encoded response body.
+    """
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class ResponseCache:
+    """
+    LRU cache of encoded JSON responses, bounded by the total size of the
+    cached bodies. Keys include a generation counter for the scope the
+    response depends on, such as a budget. Bumping the generation makes
+    every entry for that scope unreachable, and they then age out of the
+    LRU. Generations are kept in memory per process. Writes made by other
+    processes arrive through LISTEN/NOTIFY and bump the same generations,
+    so they are only seen late while the listening connection is down,
+    and reconnecting bumps every scope. Compressed copies of a body are
+    kept with it, so each one is only compressed once.
+    """
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.epoch = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def generation(self, scope):
+        return (self.epoch, self.generations.get(scope, 0))
+
+    def bump(self, scope):
+        with self.lock:
+            if scope is AllScopes:
+                self.epoch += 1
+                # Nothing cached can be reached any more
+                self.entries.clear()
+                self.size = 0
+            else:
+                self.generations[scope] = self.generations.get(scope, 0) + 1
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, status_code, body, etag=None):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= entry_size(old)
+            entry = (status_code, body, etag, {})
+            self.entries[key] = entry
+            self.size += len(body)
+            self.evict()
+        return entry
+
+    def encoded(self, key, entry, encoding, compress):
+        """
+        The entry's body compressed with the given content coding,
+        compressing it and keeping the result the first time.
+        """
+        encoded = entry[3]
+        data = encoded.get(encoding, None)
+        if data is None:
+            data = compress(entry[1], encoding)
+            with self.lock:
+                # Only count it if the entry wasn't evicted meanwhile
+                if self.entries.get(key, None) is entry and encoding not in encoded:
+                    encoded[encoding] = data
+                    self.size += len(data)
+                    self.evict()
+        return data
+
+    def evict(self):
+        # Evict the least recently used entries until it fits
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= entry_size(evicted)
+
+
+def entry_size(entry):
+    return len(entry[1]) + sum(len(data) for data in entry[3].values())
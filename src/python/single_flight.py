@@ -0,0 +1,58 @@
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+
+class Flight:
+    def __init__(self):
+        self.future = Future()
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls made with the same key. The first caller
+    runs the function and everyone who asks for the same key while it is
+    running waits for and shares its result, or its exception. A caller
+    that has waited timeout seconds stops waiting and runs the function
+    itself, so one stuck call can't hold up everyone behind it for good.
+    """
+    def __init__(self, timeout=30):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.timeout = timeout
+
+    def do(self, key, func):
+        """
+        Returns the result of func() and the number of callers that
+        shared it, or None for callers that only waited. Callers that
+        gave up waiting and ran func() themselves count as 1.
+        """
+        with self.lock:
+            flight = self.flights.get(key, None)
+            if flight is None:
+                flight = Flight()
+                self.flights[key] = flight
+                leader = True
+            else:
+                flight.waiters += 1
+                leader = False
+        if not leader:
+            try:
+                return flight.future.result(self.timeout), None
+            except FutureTimeoutError:
+                return func(), 1
+        try:
+            result = func()
+        except BaseException as e:
+            self.land(key)
+            flight.future.set_exception(e)
+            raise
+        callers = self.land(key)
+        flight.future.set_result(result)
+        return result, callers
+
+    def land(self, key):
+        # Nobody can join once it's removed, so the count is final
+        with self.lock:
+            flight = self.flights.pop(key)
+            return flight.waiters + 1
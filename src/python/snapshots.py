@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+
+
+class SnapshotStore:
+    """
+    Read-only view of the snapshots JSON file that can be reloaded while
+    the API is running. A reload parses the new file fully before swapping
+    it in, so readers always see either the old or the new data. Nothing
+    is read until load() is first called.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self.mtime = None
+        self.version = 0
+        self.lock = threading.Lock()
+        # Set to have the watcher thread reload the file right away
+        self.reload_requested = threading.Event()
+
+    def load(self):
+        with self.lock:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path) as f:
+                data = json.load(f)
+            self.data = data
+            self.mtime = mtime
+            self.version += 1
+        print(f"Loaded {len(data)} snapshot symbols from {self.path}")
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self.mtime:
+            return False
+        self.load()
+        return True
+
+    def request_reload(self):
+        """
+        Have the watcher thread reload the file even if it hasn't changed.
+        Safe to call from a signal handler.
+        """
+        self.reload_requested.set()
+
+    def watch(self, interval=5):
+        """
+        Start a daemon thread that reloads the file whenever it changes
+        or a reload is requested.
+        """
+        def _watch():
+            while True:
+                requested = self.reload_requested.wait(interval)
+                self.reload_requested.clear()
+                try:
+                    if requested:
+                        self.load()
+                    else:
+                        self.reload_if_changed()
+                except (OSError, ValueError) as e:
+                    print(f"Failed to reload {self.path}: {e}")
+        thread = threading.Thread(target=_watch, name="snapshot-watcher", daemon=True)
+        thread.start()
+        return thread
+
+    def keys(self):
+        return self.data.keys()
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
@@ -1,13 +1,75 @@
+import contextlib
 import functools
+import itertools
 import psycopg2
 import decimal
+import threading
 from datetime import time, date, datetime, timedelta
 from decimal import Decimal
+from time import monotonic, perf_counter
 from flask import request, jsonify, abort
 
 
 PrimaryKey = object()
 
+# Table-level declarations, used as keys in a table's schema alongside
+# its columns:
+#   Unique: list of column name tuples that must be unique together
+#   Triggers: {name: (events, plpgsql body)} for row triggers on the table
+#   Initialize: SQL run once, right after the table is created
+#   Indexes: {name: definition after ON <table>}, e.g. "USING gin (...)"
+#   PartitionBy: RangePartitions(...) to range partition the table
+Unique = object()
+Triggers = object()
+Initialize = object()
+Indexes = object()
+PartitionBy = object()
+
+
+class RangePartitions:
+    """
+    Range partitioning of a table by a date column, with a partition for
+    each month or year named <table>_<yyyy>_<mm> or <table>_<yyyy>, and a
+    <table>_default partition for rows outside all of them. Partitions are
+    created for the current period and the ahead periods after it.
+    """
+    def __init__(self, column, interval="year", ahead=1):
+        if interval not in ("month", "year"):
+            raise ValueError(f"unsupported partition interval '{interval}'")
+        self.column = column
+        self.interval = interval
+        self.ahead = ahead
+
+    def start_of(self, day):
+        return date(day.year, day.month if self.interval == "month" else 1, 1)
+
+    def after(self, start):
+        if self.interval == "year":
+            return date(start.year + 1, 1, 1)
+        return date(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+    def upcoming(self, day):
+        start = self.start_of(day)
+        for _ in range(self.ahead + 1):
+            yield start
+            start = self.after(start)
+
+    def name(self, table, start):
+        return f"{table}_{start:%Y}" if self.interval == "year" else f"{table}_{start:%Y_%m}"
+
+    def start_from_name(self, table, name):
+        """
+        The start of the period a partition covers, from its name, or None
+        if it isn't one of the table's period partitions.
+        """
+        if not name.startswith(table + "_"):
+            return None
+        try:
+            start = datetime.strptime(name[len(table) + 1:], "%Y" if self.interval == "year" else "%Y_%m")
+        except ValueError:
+            return None
+        return start.date()
+
 class Money:
     @staticmethod
     def validate_json(app, key):
@@ -26,6 +88,14 @@ class Money:
             abort(response)
 
 
+class OptionalMoney:
+    @staticmethod
+    def validate_json(app, key):
+        if request.json.get(key, None) is None:
+            return None
+        return Money.validate_json(app, key)
+
+
 foreign_key_cache = {}
 def ForeignKey(category, primary_key, rule="CASCADE"):
     kind = foreign_key_cache.get((category, rule), object())
@@ -34,19 +104,49 @@ def ForeignKey(category, primary_key, rule="CASCADE"):
     return kind
 
 
+def connection_lost(connection, error):
+    # Connection failures come back as these exact types with no SQLSTATE,
+    # or in the connection exception and operator intervention classes
+    return (connection.closed
+        or (error.pgcode is None and type(error) in (psycopg2.DatabaseError, psycopg2.OperationalError, psycopg2.InterfaceError))
+        or (error.pgcode or "")[:2] in ("08", "57"))
+
+
 def ensure_connection(func):
     @functools.wraps(func)
     def _ensure_connection(self, *args, **kwargs):
         if self.connection is None:
+            # Reconnecting would silently carry on outside the transaction
+            if self.local.depth:
+                raise psycopg2.InterfaceError("connection lost during transaction")
             self.connect()
         try:
             return func(self, *args, **kwargs)
-        except:
-            self.connection = None
+        except psycopg2.Error as e:
+            # Open a new connection next time if this one was lost
+            if self.connection is not None and connection_lost(self.connection, e):
+                self.connection.close()
+                self.connection = None
             raise
     return _ensure_connection
 
 
+def instrumented(func):
+    @functools.wraps(func)
+    def _instrumented(self, sql, params=None):
+        # Skip the timing entirely when nobody is listening
+        if not self.hooks:
+            return func(self, sql, params)
+        start = perf_counter()
+        try:
+            return func(self, sql, params)
+        finally:
+            duration = perf_counter() - start
+            for hook in self.hooks:
+                hook(sql, duration)
+    return _instrumented
+
+
 sql_type_conversions = {
     str: "text",
     int: "bigint",
@@ -66,19 +166,327 @@ def python_to_sql_type(name, python_type):
     return f"{name} {sql_type_conversions[python_type]}"
 
 
+def make_dsn(dsn):
+    # A bare database name is accepted too
+    if "=" not in dsn and "://" not in dsn:
+        return f"dbname={dsn}"
+    return dsn
+
+
+def fetch_all(connection, sql, params=None):
+    with connection.cursor() as cursor:
+        # Execute query
+        if params:
+            cursor.execute(sql, params)
+        else:
+            cursor.execute(sql)
+        # Check what kind of results are ready
+        if cursor.description is None:
+            return None
+        # Fetch results
+        results = cursor.fetchall()
+        if results is None:
+            return None
+        # For single column queries, return a flat list of items
+        if len(cursor.description) == 1:
+            return [result[0] for result in results]
+        else:
+            return results
+
+
+def fetch_one(connection, sql, params=None):
+    with connection.cursor() as cursor:
+        # Execute query
+        if params:
+            cursor.execute(sql, params)
+        else:
+            cursor.execute(sql)
+        # Check what kind of results are ready
+        if cursor.description is None:
+            return None
+        # Fetch results
+        result = cursor.fetchone()
+        if result is None:
+            return None
+        # For single column queries, return a single item
+        if len(cursor.description) == 1:
+            return result[0]
+        else:
+            return result
+
+
+class Replica:
+    """
+    A read-only copy of the database. After a connection error it is left
+    out of rotation for eject_seconds, then tried again.
+    """
+    def __init__(self, dsn, eject_seconds=30):
+        self.dsn = make_dsn(dsn)
+        self.eject_seconds = eject_seconds
+        self.ejected_until = 0
+
+    @property
+    def healthy(self):
+        return monotonic() >= self.ejected_until
+
+    def eject(self):
+        self.ejected_until = monotonic() + self.eject_seconds
+
+
+class ConnectionState(threading.local):
+    def __init__(self):
+        self.connection = None
+        # Replica DSN -> connection
+        self.replica_connections = {}
+        # Set while a write is being sent, so it goes to the primary
+        self.writing = False
+        # Nesting depth of transaction() blocks
+        self.depth = 0
+        # Nesting depth of primary_reads() blocks
+        self.primary_reads = 0
+        # Settings and progress of a deferred_commits() block
+        self.batch_size = None
+        self.interval = None
+        self.pending = 0
+        self.pending_since = None
+
+
 class DB:
-    def __init__(self, dbname, schema=None):
+    """
+    Each thread gets its own connection. Statements commit on their own
+    unless they are inside a transaction() or deferred_commits() block.
+
+    Reads are spread round-robin over any replicas, falling back to the
+    primary when none are healthy. Writes, and reads inside a transaction
+    or a batch of deferred writes, always go to the primary. So do reads
+    for sticky_seconds after a write by the same sticky_key(), such as the
+    current user, so they see their own writes despite replication lag,
+    and reads inside a primary_reads() block.
+    """
+    def __init__(self, dsn, schema=None, replicas=(), sticky_key=None,
+            sticky_seconds=0, eject_seconds=30, extensions=()):
         if schema is None:
             schema = {}
-        self.dbname = dbname
-        self.connection = None
+        self.dsn = make_dsn(dsn)
+        self.replicas = [Replica(replica, eject_seconds) for replica in replicas]
+        self.next_replica = itertools.count()
+        self.sticky_key = sticky_key
+        self.sticky_seconds = sticky_seconds
+        # sticky_key() -> time of its last write, shared by every thread
+        self.last_writes = {}
+        self.last_writes_lock = threading.Lock()
+        self.local = ConnectionState()
         self.schema = schema
+        self.extensions = extensions
+        self.hooks = []
+
+    @property
+    def connection(self):
+        return self.local.connection
+
+    @connection.setter
+    def connection(self, connection):
+        self.local.connection = connection
+
+    def add_hook(self, hook):
+        """
+        Register a function to be called as hook(sql, duration) after
+        every statement and commit sent to the database.
+        """
+        self.hooks.append(hook)
+        return hook
 
     def validate_schema(self):
-        tables = self.query("SELECT table_name FROM information_schema.tables WHERE table_schema='public'")
-        for table, columns in self.schema.items():
-            if table not in tables:
-                self.execute(f'CREATE TABLE {table} ({", ".join(python_to_sql_type(name, python_type) for name, python_type in columns.items())});')
+        """
+        Create any missing extensions, tables, triggers and indexes.
+        Everything is done in one transaction, so a table's Initialize step
+        sees a consistent view of the tables whose triggers keep it up to
+        date. Extensions and indexes only speed things up, so one that can't
+        be created is logged and skipped. Building an index blocks writes
+        to its table, so create large ones CONCURRENTLY by hand beforehand.
+        """
+        with self.transaction():
+            for extension in self.extensions:
+                try:
+                    with self.transaction():
+                        self.query(f'CREATE EXTENSION IF NOT EXISTS {extension};')
+                except psycopg2.Error as e:
+                    print(f"Failed to create extension {extension}: {e}")
+            tables = self.query("SELECT table_name FROM information_schema.tables WHERE table_schema='public'")
+            triggers = self.query("SELECT tgname FROM pg_trigger WHERE NOT tgisinternal")
+            created = []
+            for table, columns in self.schema.items():
+                if table not in tables:
+                    partitions = columns.get(PartitionBy, None)
+                    if partitions is None:
+                        definitions = [python_to_sql_type(name, python_type) for name, python_type in columns.items() if isinstance(name, str)]
+                        definitions += [f'UNIQUE ({", ".join(names)})' for names in columns.get(Unique, ())]
+                        self.query(f'CREATE TABLE {table} ({", ".join(definitions)});')
+                    else:
+                        # Primary keys and unique constraints of a partitioned
+                        # table have to include the partition column
+                        keys = [name for name, python_type in columns.items() if python_type is PrimaryKey]
+                        definitions = [f"{name} serial" if python_type is PrimaryKey else python_to_sql_type(name, python_type)
+                            for name, python_type in columns.items() if isinstance(name, str)]
+                        definitions += [f'PRIMARY KEY ({", ".join(keys + [partitions.column])})']
+                        definitions += [f'UNIQUE ({", ".join(names + (partitions.column,))})' for names in columns.get(Unique, ())]
+                        self.query(f'CREATE TABLE {table} ({", ".join(definitions)}) PARTITION BY RANGE ({partitions.column});')
+                        self.query(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT;')
+                    created.append(table)
+            # Trigger functions are replaced every time so changes to them are
+            # picked up, but the triggers themselves are only created once
+            for table, columns in self.schema.items():
+                for name, (events, body) in columns.get(Triggers, {}).items():
+                    self.query(f'CREATE OR REPLACE FUNCTION {name}() RETURNS trigger AS $$ {body} $$ LANGUAGE plpgsql;')
+                    if name not in triggers:
+                        self.query(f'CREATE TRIGGER {name} {events} ON {table} FOR EACH ROW EXECUTE FUNCTION {name}();')
+            for table, columns in self.schema.items():
+                for name, definition in columns.get(Indexes, {}).items():
+                    try:
+                        with self.transaction():
+                            self.query(f'CREATE INDEX IF NOT EXISTS {name} ON {table} {definition};')
+                    except psycopg2.Error as e:
+                        print(f"Failed to create index {name}: {e}")
+            self.create_partitions()
+            for table in created:
+                if Initialize in self.schema[table]:
+                    self.query(self.schema[table][Initialize])
+
+    def partitioned_tables(self):
+        return [table for table, columns in self.schema.items() if PartitionBy in columns]
+
+    def partitions(self, table):
+        return self.query("""
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON parent.oid=pg_inherits.inhparent
+            JOIN pg_class child ON child.oid=pg_inherits.inhrelid
+            WHERE parent.relname=%s;
+        """, (table,))
+
+    def create_partitions(self, tables=None, starts=()):
+        """
+        Create the upcoming partitions of range partitioned tables, along
+        with partitions for the periods starting at starts and for rows
+        that ended up in the default partition, which are moved out of it.
+        Defaults to every partitioned table that exists.
+        """
+        if tables is None:
+            tables = self.partitioned_tables()
+        with self.transaction():
+            for table in tables:
+                partitions = self.schema[table][PartitionBy]
+                existing = self.partitions(table)
+                if not existing:
+                    continue
+                periods = set(partitions.upcoming(date.today()))
+                periods.update(partitions.start_of(start) for start in starts)
+                periods.update(self.query(f"""
+                    SELECT DISTINCT date_trunc('{partitions.interval}', {partitions.column})::date
+                    FROM {table}_default;
+                """))
+                for start in sorted(periods):
+                    if partitions.name(table, start) not in existing:
+                        self.create_partition(table, start)
+
+    def create_partition(self, table, start):
+        partitions = self.schema[table][PartitionBy]
+        name = partitions.name(table, start)
+        default = f"{table}_default"
+        bounds = f"FOR VALUES FROM ('{start}') TO ('{partitions.after(start)}')"
+        in_range = f"{partitions.column}>='{start}' AND {partitions.column}<'{partitions.after(start)}'"
+        with self.transaction():
+            if self.query_one(f"SELECT EXISTS (SELECT FROM {default} WHERE {in_range});"):
+                # A partition can't be added while the default one has rows
+                # that belong in it, so move them into it first. They aren't
+                # changing, so the default partition's triggers are off
+                # while they move.
+                self.query(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+                self.query(f"ALTER TABLE {default} DISABLE TRIGGER USER;")
+                self.query(f"""
+                    WITH moved AS (DELETE FROM {default} WHERE {in_range} RETURNING *)
+                    INSERT INTO {name} SELECT * FROM moved;
+                """)
+                self.query(f"ALTER TABLE {default} ENABLE TRIGGER USER;")
+                self.query(f"ALTER TABLE {table} ATTACH PARTITION {name} {bounds};")
+            else:
+                self.query(f"CREATE TABLE {name} PARTITION OF {table} {bounds};")
+        print(f"Created partition {name}")
+
+    def partition_table(self, table):
+        """
+        Replace an existing unpartitioned table with the range partitioned
+        table its schema declares, and copy its rows over, in one
+        transaction. The rows aren't changing, so triggers are off for the
+        copy. Writes to the table wait until it is done.
+        """
+        columns = self.schema[table]
+        partitions = columns[PartitionBy]
+        old = f"{table}_unpartitioned"
+        names = ", ".join(name for name in columns if isinstance(name, str))
+        with self.transaction():
+            self.query(f"ALTER TABLE {table} RENAME TO {old};")
+            # Free up the names of the new table's triggers, indexes and key
+            for name in columns.get(Triggers, {}):
+                self.query(f"DROP TRIGGER IF EXISTS {name} ON {old};")
+            for name in columns.get(Indexes, {}):
+                self.query(f"DROP INDEX IF EXISTS {name};")
+            self.query(f"ALTER TABLE {old} DROP CONSTRAINT IF EXISTS {table}_pkey;")
+            # Create the new table with a partition for every period that has
+            # rows, so none of them end up in the default partition
+            starts = self.query(f"""
+                SELECT DISTINCT date_trunc('{partitions.interval}', {partitions.column})::date
+                FROM {old};
+            """)
+            self.validate_schema()
+            self.create_partitions([table], starts)
+            for partition in self.partitions(table):
+                self.query(f"ALTER TABLE {partition} DISABLE TRIGGER USER;")
+            self.query(f"INSERT INTO {table} ({names}) SELECT {names} FROM {old};")
+            for partition in self.partitions(table):
+                self.query(f"ALTER TABLE {partition} ENABLE TRIGGER USER;")
+            # New ids carry on from the copied ones
+            for name, python_type in columns.items():
+                if python_type is PrimaryKey:
+                    self.query(f"""
+                        SELECT setval(pg_get_serial_sequence('{table}', '{name}'), COALESCE(MAX({name}), 0) + 1, false)
+                        FROM {table};
+                    """)
+            self.query(f"DROP TABLE {old};")
+
+    def is_partitioned(self, table):
+        return self.query_one("SELECT relkind='p' FROM pg_class WHERE relname=%s;", (table,))
+
+    def detach_partitions(self, table, before):
+        """
+        Detach the partitions of table that only hold rows from before the
+        given date, and rename them <partition>_archived_<yyyymmdd> so they
+        can be dumped and dropped. Returns their new names.
+        """
+        partitions = self.schema[table][PartitionBy]
+        archived = []
+        with self.transaction():
+            for name in self.partitions(table):
+                start = partitions.start_from_name(table, name)
+                if start is None or partitions.after(start) > before:
+                    continue
+                archive = f"{name}_archived_{date.today():%Y%m%d}"
+                self.query(f"ALTER TABLE {table} DETACH PARTITION {name};")
+                self.query(f"ALTER TABLE {name} RENAME TO {archive};")
+                archived.append(archive)
+        return archived
+
+    def rebuild(self, tables=None):
+        """
+        Empty tables and fill them again with their Initialize step, in one
+        transaction. Defaults to every table that has an Initialize step.
+        Writes that would touch the tables wait until the rebuild is done.
+        """
+        if tables is None:
+            tables = [table for table, columns in self.schema.items() if Initialize in columns]
+        with self.transaction():
+            self.query(f'TRUNCATE {", ".join(tables)};')
+            for table in tables:
+                self.query(self.schema[table][Initialize])
 
     def connect(self):
         # Close connection if it is open
@@ -86,56 +494,178 @@ class DB:
             self.connection.close()
             self.connection = None
         # Open a new connection
-        self.connection = psycopg2.connect(dbname=self.dbname)
+        self.connection = psycopg2.connect(self.dsn)
+        # Transactions are started explicitly, so reads don't leave one
+        # open holding locks
+        self.connection.autocommit = True
+
+    def _replica_connection(self, replica):
+        connection = self.local.replica_connections.get(replica.dsn, None)
+        if connection is None or connection.closed:
+            connection = psycopg2.connect(replica.dsn)
+            connection.autocommit = True
+            self.local.replica_connections[replica.dsn] = connection
+        return connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run the statements in the block as one transaction, committed when
+        the block exits and rolled back if it raises. Nested blocks use
+        savepoints, so an exception caught outside a nested block only
+        undoes that block.
+        """
+        depth = self.local.depth
+        if depth == 0:
+            self.flush()
+            if self.connection is None:
+                self.connect()
+        # Count the block as open first, so everything in it, from BEGIN
+        # on, goes to the primary
+        self.local.depth = depth + 1
+        try:
+            self.query("BEGIN" if depth == 0 else f"SAVEPOINT transaction_{depth}")
+            connection = self.connection
+            try:
+                yield self
+            except:
+                # Nothing to undo if the connection was lost
+                if self.connection is connection:
+                    self.query("ROLLBACK" if depth == 0 else f"ROLLBACK TO SAVEPOINT transaction_{depth}")
+                raise
+            self.query("COMMIT" if depth == 0 else f"RELEASE SAVEPOINT transaction_{depth}")
+        finally:
+            self.local.depth = depth
+
+    @contextlib.contextmanager
+    def primary_reads(self):
+        """
+        Send the reads in the block to the primary, for results that have
+        to be up to date, such as ones that are cached until the next write.
+        """
+        self.local.primary_reads += 1
+        try:
+            yield
+        finally:
+            self.local.primary_reads -= 1
+
+    @contextlib.contextmanager
+    def deferred_commits(self, batch_size=100, interval=1.0):
+        """
+        For bulk writers. Writes outside of transaction() blocks are grouped
+        and committed together once batch_size of them are waiting or the
+        oldest has waited interval seconds, and on leaving the block. A
+        crash or a failed write loses the writes still waiting.
+        """
+        self.local.batch_size = batch_size
+        self.local.interval = interval
+        try:
+            yield self
+        finally:
+            self.local.batch_size = None
+            self.flush()
+
+    def flush(self):
+        """
+        Commit any writes waiting in a deferred_commits() block.
+        """
+        if self.local.pending:
+            try:
+                self.query("COMMIT")
+            finally:
+                self.local.pending = 0
+
+    def _write(self, query, sql, params):
+        self.local.writing = True
+        try:
+            result = self._commit_write(query, sql, params)
+        finally:
+            self.local.writing = False
+        # Note the write for read-your-writes
+        if self.sticky_seconds and self.sticky_key is not None:
+            key = self.sticky_key()
+            if key is not None:
+                now = monotonic()
+                with self.last_writes_lock:
+                    if len(self.last_writes) > 10000:
+                        self.last_writes = {
+                            other: written for other, written in self.last_writes.items()
+                            if now - written < self.sticky_seconds
+                        }
+                    self.last_writes[key] = now
+        return result
+
+    def _commit_write(self, query, sql, params):
+        # Writes commit on their own, unless they are in a transaction
+        if self.local.depth or self.local.batch_size is None:
+            return query(sql, params)
+        if not self.local.pending:
+            self.query("BEGIN")
+            self.local.pending_since = monotonic()
+        try:
+            result = query(sql, params)
+        except psycopg2.Error:
+            # The batch can't be committed after a failed statement
+            if self.connection is not None:
+                self.query("ROLLBACK")
+            self.local.pending = 0
+            raise
+        self.local.pending += 1
+        if (self.local.pending >= self.local.batch_size
+                or monotonic() - self.local.pending_since >= self.local.interval):
+            self.flush()
+        return result
+
+    def _use_primary(self):
+        if (not self.replicas or self.local.writing or self.local.depth
+                or self.local.pending or self.local.primary_reads):
+            return True
+        if self.sticky_seconds and self.sticky_key is not None:
+            key = self.sticky_key()
+            with self.last_writes_lock:
+                written = self.last_writes.get(key, None)
+            if written is not None and monotonic() - written < self.sticky_seconds:
+                return True
+        return False
+
+    def _read(self, fetch, sql, params=None):
+        if not self._use_primary():
+            # Try each healthy replica at most once, starting from the next
+            # one in the rotation
+            start = next(self.next_replica)
+            for i in range(len(self.replicas)):
+                replica = self.replicas[(start + i) % len(self.replicas)]
+                if not replica.healthy:
+                    continue
+                connection = None
+                try:
+                    connection = self._replica_connection(replica)
+                    return fetch(connection, sql, params)
+                except psycopg2.Error as e:
+                    # Errors in the query itself aren't the replica's fault
+                    if connection is not None:
+                        if not connection_lost(connection, e):
+                            raise
+                        connection.close()
+                    self.local.replica_connections.pop(replica.dsn, None)
+                    replica.eject()
+                    print(f"Ejected replica {replica.dsn} for {replica.eject_seconds}s: {e}")
+        return self._read_primary(fetch, sql, params)
 
     @ensure_connection
+    def _read_primary(self, fetch, sql, params=None):
+        return fetch(self.connection, sql, params)
+
+    @instrumented
     def query(self, sql, params=None):
-        with self.connection.cursor() as cursor:
-            # Execute query
-            if params:
-                cursor.execute(sql, params)
-            else:
-                cursor.execute(sql)
-            # Check what kind of results are ready
-            if cursor.description is None:
-                return None
-            # Fetch results
-            results = cursor.fetchall()
-            if results is None:
-                return None
-            # For single column queries, return a flat list of items
-            if len(cursor.description) == 1:
-                return [result[0] for result in results]
-            else:
-                return results
-    
-    @ensure_connection
+        return self._read(fetch_all, sql, params)
+
+    @instrumented
     def query_one(self, sql, params=None):
-        with self.connection.cursor() as cursor:
-            # Execute query
-            if params:
-                cursor.execute(sql, params)
-            else:
-                cursor.execute(sql)
-            # Check what kind of results are ready
-            if cursor.description is None:
-                return None
-            # Fetch results
-            result = cursor.fetchone()
-            if result is None:
-                return None
-            # For single column queries, return a single item
-            if len(cursor.description) == 1:
-                return result[0]
-            else:
-                return result
+        return self._read(fetch_one, sql, params)
 
     def execute(self, sql, params=None):
-        results = self.query(sql, params)
-        self.connection.commit()
-        return results
+        return self._write(self.query, sql, params)
 
     def execute_one(self, sql, params=None):
-        result = self.query_one(sql, params)
-        self.connection.commit()
-        return result
+        return self._write(self.query_one, sql, params)
@@ -0,0 +1,85 @@
+import threading
+import time
+import unittest
+
+from single_flight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+    def run_callers(self, single_flight, func, count):
+        """
+        Call single_flight.do() from count threads at once, returning what
+        each one got back or raised.
+        """
+        outcomes = [None] * count
+        barrier = threading.Barrier(count)
+
+        def call(i):
+            barrier.wait()
+            try:
+                outcomes[i] = single_flight.do("key", func)
+            except Exception as e:
+                outcomes[i] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_concurrent_calls_run_once(self):
+        calls = []
+
+        def func():
+            calls.append(None)
+            time.sleep(0.2)
+            return "result"
+
+        outcomes = self.run_callers(SingleFlight(), func, 8)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([result for result, _ in outcomes], ["result"] * 8)
+        # The leader reports everyone who shared its call
+        self.assertEqual(sorted(callers for _, callers in outcomes if callers is not None), [8])
+
+    def test_exceptions_reach_followers(self):
+        calls = []
+
+        def func():
+            calls.append(None)
+            time.sleep(0.2)
+            raise ValueError("failed")
+
+        outcomes = self.run_callers(SingleFlight(), func, 8)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(outcomes), 8)
+        for outcome in outcomes:
+            self.assertIsInstance(outcome, ValueError)
+            self.assertEqual(str(outcome), "failed")
+
+    def test_followers_stop_waiting_after_timeout(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def stuck():
+            started.set()
+            release.wait(5)
+            return "stuck"
+
+        single_flight = SingleFlight(timeout=0.1)
+        leader = threading.Thread(target=single_flight.do, args=("key", stuck))
+        leader.start()
+        started.wait()
+        # The follower gives up on the stuck call and runs its own
+        self.assertEqual(single_flight.do("key", lambda: "own"), ("own", 1))
+        release.set()
+        leader.join()
+
+    def test_later_calls_run_again(self):
+        single_flight = SingleFlight()
+        self.assertEqual(single_flight.do("key", lambda: 1), (1, 1))
+        self.assertEqual(single_flight.do("key", lambda: 2), (2, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+import base64
+import time
+import unittest
+from datetime import datetime, timezone
+
+from tokens import TokenDenylist, TokenSigner, parse_keys
+
+
+class RevokedTokensTable:
+    """
+    Stands in for a database holding the revoked_tokens table, answering
+    the statements TokenDenylist makes.
+    """
+    def __init__(self):
+        self.rows = {}
+
+    def execute(self, sql, params=None):
+        statement = sql.split()[0]
+        if statement == "INSERT":
+            token_id, expires_at = params
+            self.rows.setdefault(token_id, expires_at)
+        elif statement == "DELETE":
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            self.rows = {token_id: expires_at for token_id, expires_at in self.rows.items()
+                if expires_at >= now}
+        else:
+            raise AssertionError(f"unexpected statement: {sql}")
+
+    def query(self, sql, params=None):
+        assert sql.split()[0] == "SELECT", sql
+        return list(self.rows)
+
+
+def key(secret):
+    return base64.b64encode(secret).decode("ascii")
+
+
+class TokenSignerTest(unittest.TestCase):
+    def setUp(self):
+        self.signer = TokenSigner(parse_keys(f"k1:{key(b'first secret')}"))
+
+    def test_round_trip(self):
+        token = self.signer.issue(42)
+        self.assertTrue(TokenSigner.looks_signed(token))
+        self.assertEqual(self.signer.verify(token), 42)
+
+    def test_tokens_without_a_nonce_verify(self):
+        message = f"v1.k1.42.{int(time.time())}.{int(time.time()) + 60}"
+        token = f"{message}.{self.signer.sign('k1', message)}"
+        self.assertEqual(self.signer.verify(token), 42)
+
+    def test_tokens_issued_together_differ(self):
+        self.assertNotEqual(self.signer.issue(42), self.signer.issue(42))
+
+    def test_scoped_tokens_only_verify_in_their_scope(self):
+        token = self.signer.issue(42, "budget_events:1", lifetime=60)
+        self.assertEqual(self.signer.verify(token, "budget_events:1"), 42)
+        self.assertIsNone(self.signer.verify(token, "budget_events:2"))
+        # A scoped token is never a login, and a login never a scoped token
+        self.assertIsNone(self.signer.verify(token))
+        self.assertIsNone(self.signer.verify(self.signer.issue(42), "budget_events:1"))
+
+    def test_expired_tokens_are_rejected(self):
+        token = self.signer.issue(42, lifetime=0)
+        self.assertIsNone(self.signer.verify(token))
+        # The claims of an expired token can still be read, for revocation
+        self.assertEqual(self.signer.claims(token)[0], 42)
+
+    def test_key_rotation(self):
+        old_token = self.signer.issue(42)
+        rotated = TokenSigner(parse_keys(f"k2:{key(b'second secret')},k1:{key(b'first secret')}"))
+        new_token = rotated.issue(42)
+        # The new key signs, and tokens signed with the old one still verify
+        self.assertEqual(new_token.split(".")[1], "k2")
+        self.assertEqual(rotated.verify(old_token), 42)
+        self.assertEqual(rotated.verify(new_token), 42)
+        # Processes that don't have the new key yet can't verify its tokens
+        self.assertIsNone(self.signer.verify(new_token))
+        # Once the old key is dropped, its tokens stop working
+        retired = TokenSigner(parse_keys(f"k2:{key(b'second secret')}"))
+        self.assertIsNone(retired.verify(old_token))
+
+    def test_tampered_tokens_are_rejected(self):
+        token = self.signer.issue(42)
+        version, key_id, user_id, issued_at, expires_at, nonce, signature = token.split(".")
+        forged = [
+            # Someone else's user id
+            ".".join((version, key_id, "43", issued_at, expires_at, nonce, signature)),
+            # A later expiry
+            ".".join((version, key_id, user_id, issued_at, str(int(expires_at) + 3600),
+                nonce, signature)),
+            # Without the nonce it was signed with
+            ".".join((version, key_id, user_id, issued_at, expires_at, signature)),
+            # A different signature
+            ".".join((version, key_id, user_id, issued_at, expires_at, nonce,
+                ("A" if signature[0] != "A" else "B") + signature[1:])),
+            # Signed with a key the signer doesn't have
+            TokenSigner(parse_keys(f"k1:{key(b'other secret')}")).issue(42),
+            token + ".extra",
+            "not a token",
+            None,
+        ]
+        for token in forged:
+            with self.subTest(token=token):
+                self.assertIsNone(self.signer.verify(token))
+
+    def test_parse_keys_rejects_bad_specs(self):
+        for spec in ("", "k1", "k1:", "k.1:" + key(b"secret")):
+            with self.subTest(spec=spec):
+                with self.assertRaises(ValueError):
+                    parse_keys(spec)
+
+
+class TokenDenylistTest(unittest.TestCase):
+    def setUp(self):
+        self.table = RevokedTokensTable()
+        self.keys = parse_keys(f"k1:{key(b'first secret')}")
+
+    def signer(self):
+        # Each signer is a separate process with its own copy of the denylist
+        return TokenSigner(self.keys, denylist=TokenDenylist(self.table))
+
+    def test_revocation_survives_a_reload(self):
+        signer = self.signer()
+        token = signer.issue(42)
+        _, _, expires_at, signature = signer.claims(token)
+        signer.denylist.revoke(signature, expires_at)
+        self.assertIsNone(signer.verify(token))
+
+        # Another process sees the revocation once it reloads
+        other = self.signer()
+        self.assertEqual(other.verify(token), 42)
+        other.denylist.load()
+        self.assertIsNone(other.verify(token))
+        # And so does the revoking process after reloading
+        signer.denylist.load()
+        self.assertIsNone(signer.verify(token))
+        # Other tokens are unaffected
+        self.assertEqual(other.verify(other.issue(42)), 42)
+
+    def test_reload_forgets_expired_revocations(self):
+        signer = self.signer()
+        token = signer.issue(42, lifetime=0)
+        _, _, expires_at, signature = signer.claims(token)
+        signer.denylist.revoke(signature, expires_at - 1)
+        signer.denylist.load()
+        self.assertNotIn(signature, signer.denylist)
+        self.assertFalse(self.table.rows)
+
+
+if __name__ == "__main__":
+    unittest.main()
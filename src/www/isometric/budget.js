@@ -1,6 +1,6 @@
 import { Budget, PERM_UPDATE, PERM_ADMIN } from "./modules/datatypes.js";
 import { errorToast } from "./modules/ui.js";
-import { apiRequest } from "./modules/api.js";
+import { apiRequest, watchBudget } from "./modules/api.js";
 
 let g_budget = null;
 const g_categoryCache = {};
@@ -337,7 +337,6 @@ $(async () => {
     });
 
     // If this budget has a parent budget, add a "Go to Parent" button
-    const parent_budget = await g_budget.parent();
     if (g_budget.previous_id) {
         const parentBudgetButton = $(`
             <button class="view-parent-budget">
@@ -347,13 +346,12 @@ $(async () => {
         `);
         $(".budget-buttons").append(parentBudgetButton);
         parentBudgetButton.on("click", ev => {
-            window.location.href = "/budget?id=" + parent_budget.id;
+            window.location.href = "/budget?id=" + g_budget.previous_id;
         });
     }
 
     // If this budget has no child, add create child button
-    const child_budget = await g_budget.child();
-    if (!child_budget) {
+    if (!g_budget.next_id) {
         const createChildButton = $(`
             <button class="create-child-budget">
             <i class="fas fa-layer-plus"></i>
@@ -375,7 +373,7 @@ $(async () => {
         `);
         $(".budget-buttons").append(childBudgetButton);
         childBudgetButton.on("click", ev => {
-            window.location.href = "/budget?id=" + child_budget.id;
+            window.location.href = "/budget?id=" + g_budget.next_id;
         });
     }
 
@@ -391,4 +389,14 @@ $(async () => {
 
     // Update the categories on load
     await updateCategories();
+
+    // Reload the categories when someone else changes the budget, one
+    // update at a time so elements aren't added twice
+    let updating = Promise.resolve();
+    watchBudget(budgetId, () => {
+        updating = updating.then(async () => {
+            g_budget._categories = null;
+            await updateCategories();
+        });
+    });
 });
@@ -1,4 +1,5 @@
-import { Budget, PERM_UPDATE, PERM_ADMIN } from "./modules/datatypes.js";
+import { apiRequest } from "./modules/api.js";
+import { Budget, PERM_UPDATE, PERM_ADMIN, moneyValue } from "./modules/datatypes.js";
 import { deriveColor } from "./modules/util.js";
 import { errorToast } from "./modules/ui.js";
 
@@ -117,60 +118,32 @@ async function generateStockGraph() {
 
 
 async function generateLineGraph() {
-    // Generate chart data
+    // Generate chart data from the totals of every budget in the chain,
+    // for the categories in this budget
     const categoryData = {};
-    const budgetLabels = [g_budget.name];
-    
-    const categories = await g_budget.categories();
-    for (const category of categories) {
+    const budgetLabels = [];
+
+    for (const category of await g_budget.categories()) {
         categoryData[category.name] = {
-            values: [(await category.total())/1000],
+            values: [],
             color: await deriveColor(category.name)
         }
     }
 
-    // Add historical data
-    let parent = await g_budget.parent();
-    while (parent)
-    {
-        const missingCategories = new Set(Object.keys(categoryData));
-        const parentCategories = await parent.categories();
-        for (const category of parentCategories)
-        {
-            if (missingCategories.has(category.name))
-            {
-                missingCategories.delete(category.name);
-                categoryData[category.name].values.unshift((await category.total()) / 1000);
-            }
-        }
-        for (const name of missingCategories)
-        {
-            categoryData[name].values.unshift(0);
-        }
-        budgetLabels.unshift(parent.name);
-        parent = await parent.parent();
+    const response = await apiRequest("/analytics/compare", {budget_id: g_budget.id});
+    if (response.error) {
+        throw response.error;
     }
-
-    // Add future data
-    let child = await g_budget.child();
-    while (child)
+    for (const budget of response.budgets)
     {
-        const missingCategories = new Set(Object.keys(categoryData));
-        const childCategories = await child.categories();
-        for (const category of childCategories)
+        for (const category of budget.categories)
         {
-            if (missingCategories.has(category.name))
+            if (categoryData[category.name])
             {
-                missingCategories.delete(category.name);
-                categoryData[category.name].values.push((await category.total()) / 1000);
+                categoryData[category.name].values.push(moneyValue(category.total) / 1000);
             }
         }
-        for (const name of missingCategories)
-        {
-            categoryData[name].values.push(0);
-        }
-        budgetLabels.push(child.name);
-        child = await child.child();
+        budgetLabels.push(budget.name);
     }
 
     // Construct datasets
@@ -258,9 +231,10 @@ $(async () => {
     const urlParams = new URLSearchParams(window.location.search);
     const budgetId = parseInt(urlParams.get('id'));
 
-    // Get budget info
+    // Get budget info, with category totals
     try {
-        g_budget = await Budget.from_id(budgetId);
+        const chain = await Budget.chain(budgetId);
+        g_budget = chain.find(budget => budget.id == budgetId);
     }
     catch (e) {
         window.location.href = "/home";
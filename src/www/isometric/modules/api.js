@@ -38,6 +38,13 @@ export async function register(username, password)
     }
 }
 
+/*
+ * Replies that came with an ETag, keyed by endpoint and request body,
+ * oldest first.
+ */
+const replyCache = new Map();
+const REPLY_CACHE_SIZE = 200;
+
 /*
  * Make a request to the API. Returns the JSON that
  * comes back.
@@ -54,14 +61,33 @@ export async function apiRequest(endpoint, data)
     if (authtoken) {
         data.authtoken = authtoken;
     }
+    const body = JSON.stringify(data);
+    const key = endpoint + " " + body;
+    const cached = replyCache.get(key);
     try {
-        return await $.ajax({
+        const request = $.ajax({
             type: "POST",
             dataType: "json",
             url: "/api" + endpoint,
-            data: JSON.stringify(data),
-            contentType: "application/json; charset=utf-8"
+            data: body,
+            contentType: "application/json; charset=utf-8",
+            headers: cached ? {"If-None-Match": cached.etag} : {}
         });
+        const reply = await request;
+        // 304 has no body, the cached reply is still current. Callers
+        // get a copy so they can't change the cached one.
+        if (request.status == 304 && cached) {
+            return structuredClone(cached.reply);
+        }
+        const etag = request.getResponseHeader("ETag");
+        replyCache.delete(key);
+        if (etag) {
+            replyCache.set(key, {etag, reply: structuredClone(reply)});
+            if (replyCache.size > REPLY_CACHE_SIZE) {
+                replyCache.delete(replyCache.keys().next().value);
+            }
+        }
+        return reply;
     }
     catch (error) {
         const reply = error.responseJSON;
@@ -74,4 +100,47 @@ export async function apiRequest(endpoint, data)
         }
         return reply;
     }
-}
\ No newline at end of file
+}
+
+/*
+ * Call onChange whenever anyone changes the budget. Changes are pushed
+ * by the server, and if it won't take the stream the budget is
+ * reloaded every so often instead.
+ */
+export async function watchBudget(budget_id, onChange, reconnecting = false)
+{
+    const retry = () => setTimeout(() => {
+        onChange();
+        watchBudget(budget_id, onChange);
+    }, 30000);
+    // The stream takes a short-lived token for this budget only, so the
+    // authtoken never ends up in a URL
+    const reply = await apiRequest("/budget/events/token", {budget_id});
+    if (!reply || !reply.token) {
+        retry();
+        return null;
+    }
+    const params = new URLSearchParams({token: reply.token, budget_id});
+    const events = new EventSource("/api/budget/events?" + params);
+    let opened = false;
+    events.addEventListener("change", ev => onChange());
+    events.onopen = ev => {
+        // Changes made while reconnecting weren't pushed
+        if (reconnecting) {
+            onChange();
+        }
+        opened = true;
+    };
+    events.onerror = ev => {
+        // The token will have expired by the time the browser reconnects,
+        // so reconnect with a new one, unless the server refused
+        events.close();
+        if (opened) {
+            watchBudget(budget_id, onChange, true);
+        }
+        else {
+            retry();
+        }
+    };
+    return events;
+}
@@ -8,6 +8,11 @@ export const PERM_ADMIN = 4;
 export const PERM_OWNER = 8;
 
 
+export function moneyValue(amount) {
+    return Number(amount.replace(/[$,]/g, ''));
+}
+
+
 export class Budget {
     constructor(id, ticker_symbol, previous_id, next_id, name, permissions)
     {
@@ -104,6 +109,38 @@ export class Budget {
         );
     }
 
+    /*
+     * Fetch every budget in this budget's chain, in order, along with
+     * their categories and category totals, in a single request.
+     */
+    static async chain(budget_id) {
+        const response = await apiRequest("/budget/chain", {budget_id});
+        if (response.error) {
+            throw response.error;
+        }
+        const budgets = [];
+        response.budgets.forEach(budgetData => {
+            const budget = new Budget(
+                budgetData.id,
+                budgetData.ticker_symbol,
+                budgetData.previous_id,
+                budgetData.next_id,
+                budgetData.name,
+                budgetData.permissions
+            );
+            budget._categories = budgetData.categories.map(categoryData => {
+                const category = new Category(
+                    categoryData.id, budget.id, categoryData.name,
+                    categoryData.total
+                );
+                category._budget = budget;
+                return category;
+            });
+            budgets.push(budget);
+        });
+        return budgets;
+    }
+
     static async list() {
         const response = await apiRequest("/budget/list");
         if (response.error) {
@@ -190,10 +227,11 @@ export class Budget {
 
 
 export class Category {
-    constructor(id, budget_id, name) {
+    constructor(id, budget_id, name, total) {
         this.id = id;
         this.budget_id = budget_id;
         this._name = name;
+        this._total = total ?? null;
         this._budget = null;
         this._expenses = null;
     }
@@ -225,6 +263,10 @@ export class Category {
     }
 
     async total() {
+        // Use the total sent by the server if there is one
+        if (this._total !== null) {
+            return moneyValue(this._total);
+        }
         let result = 0;
         const expenses = await this.expenses();
         for (const expense of expenses) {
@@ -254,7 +296,8 @@ export class Category {
         return new Category(
             category_id,
             budget_id,
-            response.name
+            response.name,
+            response.total
         );
     }
 
@@ -266,7 +309,7 @@ export class Category {
         const categories = [];
         response.categories.forEach(category => {
             categories.push(new Category(
-                category.id, budget_id, category.name
+                category.id, budget_id, category.name, category.total
             ));
         });
         return categories;
@@ -291,6 +334,8 @@ export class Category {
             response.id, this.id, this.budget_id,
             description, amount, date
         );
+        // The server's total no longer includes every expense
+        this._total = null;
         expense._category = this;
         expense._budget = this._budget;
         if (this._expenses !== null) {
@@ -345,7 +390,7 @@ export class Expense {
     }
 
     get value() {
-        return Number(this._amount.substring(1).replaceAll(',', ''));
+        return moneyValue(this._amount);
     }
 
     get date() {
@@ -371,6 +416,9 @@ export class Expense {
         this._description = response.description;
         this._amount = response.amount;
         this._date = response.date;
+        if (this._category) {
+            this._category._total = null;
+        }
     }
 
     async category() {
@@ -427,6 +475,7 @@ export class Expense {
         // Get category
         const category = await this.category();
         // Remove expense from category's expenses list
+        category._total = null;
         if (category._expenses !== null) {
             const index = category._expenses.indexOf(this)
             if (index != -1) {